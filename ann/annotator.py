@@ -3,12 +3,76 @@ import subprocess
 import botocore
 import boto3
 import json
+import sys
 import os
+import shutil
+
+import preflight
+
+sys.path.insert(1, '/home/ec2-user/mpcs-cc/gas/util')
+import helpers
+import job_stats
 
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
 
+stats = job_stats.JobStats(config)
+
+# S3 errors for an input file that retrying will not fix
+PERMANENT_S3_ERRORS = ('NoSuchKey', 'NoSuchBucket', 'AccessDenied', '403', '404')
+
+"""Put a claimed job back to PENDING after its local setup failed, so
+the redelivered request can claim it again
+"""
+def release_job(table, id, user_id):
+    try:
+        table.update_item(
+            Key={'job_id': id},
+            UpdateExpression="set job_status = :new_status",
+            ExpressionAttributeValues={
+                ':new_status': 'PENDING',
+                ':expected_status': 'RUNNING'
+                },
+            ConditionExpression='job_status = :expected_status'
+        )
+        stats.status_changed(user_id, 'RUNNING', 'PENDING')
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Job {} could not be released: {}'.format(id, str(e))
+            })
+
+"""Move a PENDING job that will never run to a final status
+Returns False if the status could not be written, in which case the
+request should stay on the queue; a job that is no longer PENDING
+counts as done.
+"""
+def end_job(table, id, user_id, status, message):
+    try:
+        table.update_item(
+            Key={'job_id': id},
+            UpdateExpression="set job_status = :new_status, status_message = :message",
+            ExpressionAttributeValues={
+                ':new_status': status,
+                ':message': message,
+                ':expected_status': 'PENDING'
+                },
+            ConditionExpression='job_status = :expected_status'
+        )
+        stats.status_changed(user_id, 'PENDING', status)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Status could not be updated. Please try again.'
+            })
+            return False
+    return True
+
 def request_annotation():
     # Connect to SQS and get the message queue
     sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
@@ -43,21 +107,12 @@ def request_annotation():
         filename = data['input_file_name']
         key = '{}{}'.format(path, data['s3_key_input_file'])
 
-        # Include below the same code you used in prior homework
-        # Get the input file S3 object and copy it to a local file
-        # Use a local directory structure hat makes it easy to organize multiple running annotation jobs
-        job_path = './jobs/{}'.format(id)
-        os.makedirs(job_path)
-        s3_client = boto3.resource('s3', region_name=config['aws']['AwsRegionName'])
-        download_path = os.path.join(job_path, filename)
-        s3_client.meta.client.download_file(bucket, key, download_path)
-
         db = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
         table = db.Table(config['aws']['AwsDynamoTable'])
 
         # Check to see if job ID is in the Dynamodb table
         try:
-            response = table.get_item(Key={'job_id':id})
+            response = table.get_item(Key={'job_id':id}, ConsistentRead=True)
 
         except botocore.exceptions.ClientError:
             print({
@@ -65,56 +120,130 @@ def request_annotation():
                 'status': 'error',
                 'message': 'Dynamodb table was not able to be accessed.'
             })
+            continue
 
         if 'Item' not in response:
+            sqs.delete_message(QueueUrl=url, ReceiptHandle=receipt_handle)
             print({
                 'code': 404,
                 'status': 'error',
                 'message': 'Job ID was not found in the Dynamodb table'
             })
+            continue
+
+        # A redelivered or resubmitted request for a job that already started
+        if response['Item']['job_status'] != 'PENDING':
+            helpers.put_metric(name='DuplicateJobsPrevented', dimensions={'Stage': 'annotator'})
+            sqs.delete_message(QueueUrl=url, ReceiptHandle=receipt_handle)
+            print({
+                'code': 409,
+                'status': 'error',
+                'message': 'Job {} is no longer pending; request ignored.'.format(id)
+            })
+            continue
+
+        # Reject malformed inputs before they take a slot or get downloaded
+        s3_client = boto3.resource('s3', region_name=config['aws']['AwsRegionName'])
+        try:
+            error, elapsed = preflight.preflight(s3_client.meta.client, bucket, key,
+                chunk_bytes=config.getint('preflight', 'ChunkBytes'),
+                max_bytes=config.getint('preflight', 'MaxBytes'),
+                sample_records=config.getint('preflight', 'SampleRecords'))
+        except botocore.exceptions.ClientError as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Input file could not be read for validation: {}'.format(str(e))
+            })
+            # A missing or unreadable input will not appear on redelivery
+            if e.response['Error']['Code'] in PERMANENT_S3_ERRORS and \
+                end_job(table, id, data['user_id'], 'FAILED', 'Input file could not be read.'):
+                sqs.delete_message(QueueUrl=url, ReceiptHandle=receipt_handle)
+            continue
+
+        helpers.put_metric(name='PreflightLatency', value=elapsed * 1000, unit='Milliseconds')
+        if error:
+            helpers.put_metric(name='PreflightRejected')
+            if not end_job(table, id, data['user_id'], 'REJECTED', error):
+                continue
+
+            sqs.delete_message(QueueUrl=url, ReceiptHandle=receipt_handle)
+            print({
+                'code': 400,
+                'status': 'error',
+                'message': 'Job {} rejected: {}'.format(id, error)
+            })
+            continue
+
+        # Claim the job before any local work so that only one annotator runs it
+        try:
+        # Source: https://stackoverflow.com/questions/37053595/how-do-i-conditionally-insert-an-item-into-a-dynamodb-table-using-boto3
+            table.update_item(
+                Key= {'job_id': id},
+                UpdateExpression="set job_status = :new_status",
+                ExpressionAttributeValues={
+                    ':new_status': 'RUNNING',
+                    ':expected_status': 'PENDING'
+                    },
+                ConditionExpression='job_status = :expected_status',
+                ReturnValues='ALL_NEW'
+            )
+            stats.status_changed(data['user_id'], 'PENDING', 'RUNNING')
+
+        # Source: https://stackoverflow.com/questions/38733363/dynamodb-put-item-conditionalcheckfailedexception
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                helpers.put_metric(name='DuplicateJobsPrevented', dimensions={'Stage': 'annotator'})
+                sqs.delete_message(QueueUrl=url, ReceiptHandle=receipt_handle)
+                print({
+                    'code': 400,
+                    'status': 'error',
+                    'message': 'Job status is not currently pending.'
+                })
+
+            else:
+                print({
+                    'code': 500,
+                    'status': 'error',
+                    'message': 'Status could not be updated. Please try again.'
+                })
+            continue
+
+        # Include below the same code you used in prior homework
+        # Get the input file S3 object and copy it to a local file
+        # Use a local directory structure hat makes it easy to organize multiple running annotation jobs
+        job_path = './jobs/{}'.format(id)
+        download_path = os.path.join(job_path, filename)
+        try:
+            # A directory left by an earlier failed attempt is reused
+            os.makedirs(job_path, exist_ok=True)
+            s3_client.meta.client.download_file(bucket, key, download_path)
+        except Exception as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Input file could not be downloaded: {}'.format(str(e))
+            })
+            # The message is left on the queue, so the job is retried
+            release_job(table, id, data['user_id'])
+            shutil.rmtree(job_path, ignore_errors=True)
+            continue
 
         try:
         # Launch annotation job as a background process
         # Source: https://docs.python.org/3/library/subprocess.html
         # Source: https://stackoverflow.com/questions/21406887/subprocess-changing-directory
             subprocess.Popen(['sh', '-c', 'python run.py jobs/{id}/{filename} {path} {id} {filename}'.format(id=id, filename=filename, path=path)])
-            
-            try:
-            # Source: https://stackoverflow.com/questions/37053595/how-do-i-conditionally-insert-an-item-into-a-dynamodb-table-using-boto3
-                table.update_item(
-                    Key= {'job_id': id},
-                    UpdateExpression="set job_status = :new_status",
-                    ExpressionAttributeValues={
-                        ':new_status': 'RUNNING',
-                        ':expected_status': 'PENDING'
-                        },
-                    ConditionExpression='job_status = :expected_status',
-                    ReturnValues='ALL_NEW'
-                )
-
-            # Source: https://stackoverflow.com/questions/38733363/dynamodb-put-item-conditionalcheckfailedexception
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                    print({
-                        'code': 400,
-                        'status': 'error',
-                        'message': 'Job status is not currently pending.'
-                    })
-
-                else:
-                    print({
-                        'code': 500,
-                        'status': 'error',
-                        'message': 'Status could not be updated. Please try again.'
-                    })
 
         # Source: https://developer.mozilla.org/en-US/docs/Web/HTTP/Status#client_error_responses
-        except subprocess.CalledProcessError:
-            return print({
+        except (subprocess.CalledProcessError, OSError):
+            print({
                 'code': 500,
                 'status': 'error',
                 'message': 'Failed annotation attempt. Please try again.'
             })
+            release_job(table, id, data['user_id'])
+            continue
 
 
         # Delete the message from the queue, if job was successfully submitted
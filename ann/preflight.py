@@ -0,0 +1,126 @@
+# preflight.py
+#
+# Cheap validation of annotation input files before a job takes an
+# annotator slot; only the first few KB of the S3 object are read
+#
+##
+
+import re
+import time
+
+from botocore import exceptions
+
+VCF_HEADER_COLUMNS = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+BASES = re.compile(r'^[ACGTN]+$', re.IGNORECASE)
+
+"""Raised when an input file does not look like a VCF file
+"""
+class PreflightError(Exception):
+    pass
+
+"""Read at most max_bytes from the start of an S3 object with ranged GETs
+Stops early once the header line and sample_records records are in hand.
+Returns the complete non-blank lines read, as (line number, line) pairs
+numbered as in the file, and whether the whole object was consumed.
+"""
+def read_head(s3, bucket, key, chunk_bytes=8192, max_bytes=65536, sample_records=20):
+    data = b''
+    eof = False
+    while len(data) < max_bytes:
+        start = len(data)
+        end = min(start + chunk_bytes, max_bytes) - 1
+        try:
+            # Source: https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html#API_GetObject_RequestSyntax
+            response = s3.get_object(Bucket=bucket, Key=key, Range='bytes={}-{}'.format(start, end))
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                # Zero-length object, or we read exactly up to the end
+                eof = True
+                break
+            raise
+
+        chunk = response['Body'].read()
+        data += chunk
+        total = int(response['ContentRange'].split('/')[-1])
+        if len(data) >= total:
+            eof = True
+            break
+
+        # Enough read once the header and a full sample of records are in
+        header_at = data.find(b'\n#CHROM')
+        if header_at != -1 and data.count(b'\n', header_at + 1) > sample_records + 1:
+            break
+
+    lines = data.decode('utf-8', errors='replace').split('\n')
+    if not eof:
+        # The last line was probably cut off by the range
+        lines = lines[:-1]
+    return [(n, line.rstrip('\r')) for n, line in enumerate(lines, start=1)
+        if line.strip()], eof
+
+"""Validate the leading (line number, line) pairs of a VCF file
+Checks the ##fileformat line, the #CHROM header line and a sample of
+data records; raises PreflightError describing the first problem found.
+A head that ends inside the ## meta-information lines is accepted.
+"""
+def validate_vcf_lines(lines, eof=True, sample_records=20):
+    if not lines:
+        raise PreflightError('File is empty.')
+
+    if not lines[0][1].startswith('##fileformat=VCFv'):
+        raise PreflightError('Missing ##fileformat=VCF line at the start of the file.')
+
+    header_index = None
+    data_index = None
+    for i, (n, line) in enumerate(lines):
+        if line.startswith('##'):
+            continue
+        if line.startswith('#'):
+            header_index = i
+        else:
+            data_index = i
+        break
+
+    if header_index is None:
+        if data_index is not None:
+            raise PreflightError('Line {}: data record before the #CHROM header line.'.format(
+                lines[data_index][0]))
+        if not eof:
+            # Still inside a long ## meta-information block; nothing
+            # wrong has been seen, so let the annotator decide
+            return
+        raise PreflightError('Missing #CHROM header line.')
+
+    columns = lines[header_index][1].split('\t')
+    if columns[:len(VCF_HEADER_COLUMNS)] != VCF_HEADER_COLUMNS:
+        raise PreflightError('Header line must start with the tab-separated columns {}.'.format(
+            ' '.join(VCF_HEADER_COLUMNS)))
+
+    records = lines[header_index + 1:header_index + 1 + sample_records]
+    if not records and eof:
+        raise PreflightError('File contains no variant records.')
+
+    for n, record in records:
+        fields = record.split('\t')
+        if len(fields) < len(VCF_HEADER_COLUMNS):
+            raise PreflightError('Line {}: expected at least {} tab-separated fields, found {}.'.format(
+                n, len(VCF_HEADER_COLUMNS), len(fields)))
+        if not fields[1].isdigit():
+            raise PreflightError('Line {}: POS "{}" is not a positive integer.'.format(n, fields[1]))
+        if not BASES.match(fields[3]):
+            raise PreflightError('Line {}: REF "{}" is not a valid base sequence.'.format(n, fields[3]))
+
+"""Run the preflight check against an S3 object
+Returns (error message or None, elapsed seconds)
+"""
+def preflight(s3, bucket, key, chunk_bytes=8192, max_bytes=65536, sample_records=20):
+    start = time.time()
+    try:
+        lines, eof = read_head(s3, bucket, key, chunk_bytes, max_bytes, sample_records)
+        validate_vcf_lines(lines, eof, sample_records)
+        error = None
+    except PreflightError as e:
+        error = str(e)
+    return error, time.time() - start
+
+### EOF
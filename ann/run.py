@@ -16,12 +16,17 @@ import botocore
 import json
 import os
 import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append('/home/ec2-user/mpcs-cc/gas/ann/anntools')
 import driver
 
 sys.path.insert(1, '/home/ec2-user/mpcs-cc/gas/util')
 import helpers
+import job_stats
+
+import vcf_summary
 
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
@@ -57,6 +62,12 @@ if __name__ == '__main__':
         name = sys.argv[4].split('.')[0]
         filename = '{}~{}'.format(id, name)
 
+        # Summarize the results file while it uploads
+        executor = ThreadPoolExecutor(max_workers=1)
+        summary_future = executor.submit(vcf_summary.summarize, './jobs/{}/{}.annot.vcf'.format(id, name),
+            block_size=config.getint('summary', 'BlockMB') * vcf_summary.MB,
+            max_keys=config.getint('summary', 'MaxKeys'))
+
         # 1. Upload the results file
         # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_file.html
         s3.upload_file('./jobs/{}/{}.annot.vcf'.format(id, name), config['aws']['AwsS3ResultsBucket'], '{}{}.annot.vcf'.format(path, filename))
@@ -64,30 +75,63 @@ if __name__ == '__main__':
         # 2. Upload the log file
         s3.upload_file('./jobs/{}/{}.vcf.count.log'.format(id, name), config['aws']['AwsS3ResultsBucket'], '{}{}.vcf.count.log'.format(path, filename))
 
+        # The job completes without a summary if the results can't be summarized
+        try:
+            summary = summary_future.result()
+        except (OSError, ValueError) as e:
+            summary = None
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Results could not be summarized: {}'.format(str(e))
+            })
+        executor.shutdown()
+
         # Change status to completed and add other information to dynamodb table
         db = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
         table = db.Table(config['aws']['AwsDynamoTable'])
 
+        user_id=table.get_item(Key ={'job_id': id})['Item']['user_id']
+
+        profile = helpers.get_user_profile(id=user_id)
+
+        complete_time = int(time.time())
+        result_size = os.path.getsize('./jobs/{}/{}.annot.vcf'.format(id, name))
+        update_expression = "set job_status = :new_status, s3_results_bucket = :results_bucket, s3_key_result_file = :results_file, s3_key_log_file = :results_log, complete_time = :time, result_size = :size"
+        values = {
+            ':new_status': 'COMPLETED',
+            ':results_bucket': config['aws']['AwsS3ResultsBucket'],
+            ':results_file': '{}{}~{}.annot.vcf'.format(path, id, name),
+            ':results_log': '{}{}~{}.vcf.count.log'.format(path, id, name),
+            ':time': complete_time,
+            ':size': result_size}
+
+        if summary is not None:
+            update_expression += ", result_summary = :summary"
+            values[':summary'] = summary
+
+        # Results of roles with a retention period are archived by the
+        # retention scheduler once retention_due has passed
+        if config.has_option('retention', profile['role']):
+            update_expression += ", retention_due = :due, retention_shard = :shard"
+            values[':due'] = complete_time + config.getint('retention', profile['role'])
+            values[':shard'] = str(zlib.crc32(id.encode('utf-8')) % config.getint('retention', 'Shards'))
+
         try:
             # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
-            table.update_item(
+            response = table.update_item(
                 Key= {'job_id': id},
-                UpdateExpression="set job_status = :new_status, s3_results_bucket = :results_bucket, s3_key_result_file = :results_file, s3_key_log_file = :results_log, complete_time = :time",
-                ExpressionAttributeValues={
-                    ':new_status': 'COMPLETED',
-                    ':results_bucket': config['aws']['AwsS3ResultsBucket'],
-                    ':results_file': '{}{}~{}.annot.vcf'.format(path, id, name),
-                    ':results_log': '{}{}~{}.vcf.count.log'.format(path, id, name),
-                    ':time': int(time.time())},
-                ReturnValues='ALL_NEW'
+                UpdateExpression=update_expression,
+                ExpressionAttributeValues=values,
+                ReturnValues='UPDATED_OLD'
             )
-        
+            # A rerun of a job that already completed changes no counts
+            old_status = response['Attributes']['job_status']
+            if old_status != 'COMPLETED':
+                job_stats.JobStats(config).completed(user_id, old_status, result_size)
+
         except botocore.exceptions.ClientError:
             print ('Status could not be updated. Please try again.')
-        
-        user_id=table.get_item(Key ={'job_id': id})['Item']['user_id']
-
-        profile = helpers.get_user_profile(id=user_id)
 
         # Information for email lambda function
         sns = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
@@ -115,20 +159,6 @@ if __name__ == '__main__':
                 'message': 'SNS Error: {}'.format(str(e))
             })
         
-        sqs_message = {
-            "job_id": id,
-            "user_name": user_id,
-            "s3_key_result_file" : "{}{}~{}.annot.vcf".format(path, id, name)
-        }
-
-        # Free users have a download limit of 5 minutes, the queue has a delayed delivery of 5 minutes to account for this
-        if profile['role'] == 'free_user':
-            sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
-            sqs.send_message(
-                QueueUrl=config['aws']['AwsSQSArchiveUrl'],
-                MessageBody=json.dumps(sqs_message)
-            )
-
         try:
         # 3. Clean up (delete) local job files
         # Source: https://www.scaler.com/topics/delete-directory-python/
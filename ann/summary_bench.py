@@ -0,0 +1,127 @@
+# summary_bench.py
+#
+# Parse throughput of vcf_summary (column-wise, by block) against a
+# naive line-by-line parser that builds a dict for every record
+#
+# Usage: python summary_bench.py [<file.annot.vcf> | <records>]
+# With a number (default 500000), a synthetic annotated VCF with that
+# many records is generated in a temporary file first. Both parsers must
+# produce the same summary.
+#
+##
+
+import os
+import sys
+import time
+import random
+import tempfile
+from collections import Counter
+
+import vcf_summary
+
+CHROMOSOMES = ['chr{}'.format(n) for n in list(range(1, 23)) + ['X', 'Y', 'M']]
+ALTS = ['A', 'C', 'G', 'T', 'AT', 'GCA', 'A,T', '<DEL>', '.']
+
+"""Write a synthetic VCF with two annotation columns after INFO
+"""
+def generate(path, records, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.1\n')
+        f.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tGENE\tDBSNP\n')
+        for n in range(records):
+            info = ['DP={}'.format(rng.randint(1, 99))]
+            if rng.random() < 0.3:
+                info.append('AF=0.{}'.format(rng.randint(1, 99)))
+            if rng.random() < 0.1:
+                info.append('DB')
+            f.write('\t'.join([
+                rng.choice(CHROMOSOMES), str(rng.randint(1, 10 ** 8)), '.',
+                rng.choice(['A', 'C', 'G', 'T', 'AC', 'TTG']), rng.choice(ALTS),
+                '50', rng.choice(['PASS', 'PASS', 'PASS', 'q10']), ';'.join(info),
+                rng.choice(['BRCA1', 'TP53', '.', '.']),
+                rng.choice(['rs{}'.format(n), '.'])
+            ]) + '\n')
+
+"""Reference parser: one decoded, split and dict-built record per line
+"""
+def naive_summarize(path, max_keys=50):
+    header = None
+    annotation_columns = []
+    variants = 0
+    chromosomes, types, filters, annotations = Counter(), Counter(), Counter(), Counter()
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            if line.startswith('#'):
+                if line.startswith('#CHROM'):
+                    header = line.lstrip('#').split('\t')
+                    extra = header[vcf_summary.STANDARD_COLUMNS:]
+                    if extra and extra[0] != 'FORMAT':
+                        annotation_columns = extra
+                continue
+
+            record = dict(zip(header, line.split('\t')))
+            info = {}
+            if record.get('INFO', '.') != '.':
+                for part in record['INFO'].split(';'):
+                    key, _, value = part.partition('=')
+                    if key:
+                        info[key] = value
+
+            variants += 1
+            chromosomes[record.get('CHROM', '')] += 1
+            filters[record.get('FILTER', '')] += 1
+            ref, alt = record.get('REF', ''), record.get('ALT', '')
+            if alt.isalpha():
+                types[vcf_summary.variant_type(len(ref), len(alt))] += 1
+            elif ',' in alt:
+                types['MULTIALLELIC'] += 1
+            else:
+                types['OTHER'] += 1
+            for key in info:
+                annotations[key] += 1
+            for name in annotation_columns:
+                if record.get(name, '') not in ('', '.'):
+                    annotations[name] += 1
+
+    return {
+        'variants': variants,
+        'chromosomes': vcf_summary.top(chromosomes, max_keys),
+        'types': dict(types),
+        'filters': vcf_summary.top(filters, max_keys),
+        'annotations': vcf_summary.top(annotations, max_keys)
+    }
+
+def timed(name, fn, path, size):
+    start = time.time()
+    result = fn(path)
+    elapsed = time.time() - start
+    print('{:<10} {:8.2f}s {:8.1f} MB/s'.format(name, elapsed, size / vcf_summary.MB / elapsed))
+    return result
+
+if __name__ == '__main__':
+    argument = sys.argv[1] if len(sys.argv) > 1 else '500000'
+    generated = None
+    if argument.isdigit():
+        generated = tempfile.NamedTemporaryFile(suffix='.annot.vcf', delete=False).name
+        generate(generated, int(argument))
+    path = generated or argument
+
+    try:
+        size = os.path.getsize(path)
+        print('{}: {:.1f} MB'.format(path, size / vcf_summary.MB))
+        naive = timed('naive', naive_summarize, path, size)
+        columnar = timed('columnar', vcf_summary.summarize, path, size)
+        if naive != columnar:
+            print('Summaries differ:\n  naive:    {}\n  columnar: {}'.format(naive, columnar))
+            sys.exit(1)
+        print('Summaries match: {} variants'.format(columnar['variants']))
+    finally:
+        if generated:
+            os.remove(generated)
+
+### EOF
@@ -0,0 +1,179 @@
+# vcf_summary.py
+#
+# Summary statistics for an annotated VCF file: variants per chromosome,
+# variant types, FILTER values and how many variants each annotation
+# (INFO key or extra annotation column) was found for
+#
+# The file is read in large blocks and each block is parsed by column:
+# the block is split into one flat array of fields, columns are strided
+# slices of it, and every statistic is a count over a whole column
+# (Counter, list.count, itertools.compress, map over bytes methods)
+# rather than a Python loop building a dict for every line. See
+# summary_bench.py for a comparison with a line-by-line parser.
+#
+##
+
+import array
+from collections import Counter
+from itertools import compress, repeat, zip_longest
+from operator import itemgetter, methodcaller, not_
+
+MB = 1024 * 1024
+
+# CHROM POS ID REF ALT QUAL FILTER INFO
+STANDARD_COLUMNS = 8
+
+"""Variant type for a simple REF/ALT pair, from their lengths
+"""
+def variant_type(ref_length, alt_length):
+    if ref_length == alt_length:
+        return 'SNV' if ref_length == 1 else 'MNV'
+    return 'INSERTION' if alt_length > ref_length else 'DELETION'
+
+"""The most common max_keys entries of a counter, plus the rest as 'other'
+Keeps the summary small enough for the job item however many contigs or
+annotations a file has
+"""
+def top(counter, max_keys):
+    common = dict(counter.most_common(max_keys))
+    rest = sum(counter.values()) - sum(common.values())
+    if '' in common:
+        # Empty fields; DynamoDB map keys can't be empty
+        common['missing'] = common.pop('')
+    if rest:
+        common['other'] = common.get('other', 0) + rest
+    return common
+
+class VcfSummary(object):
+    def __init__(self):
+        self.variants = 0
+        self.chromosomes = Counter()
+        self.types = Counter()
+        self.filters = Counter()
+        self.annotations = Counter()
+        # Names of the columns after INFO when they are annotations
+        # rather than FORMAT and sample genotype columns
+        self.annotation_columns = []
+        self.in_header = True
+
+    def set_header(self, line):
+        extra = line.split(b'\t')[STANDARD_COLUMNS:]
+        if extra and extra[0] != b'FORMAT':
+            self.annotation_columns = extra
+
+    """Add complete lines (without their final newline)
+    """
+    def add_lines(self, data):
+        if b'\r' in data:
+            data = data.replace(b'\r', b'')
+        if self.in_header:
+            start = 0
+            while start < len(data) and data[start:start + 1] in (b'#', b'\n'):
+                end = data.find(b'\n', start)
+                end = len(data) if end == -1 else end
+                if data.startswith(b'#CHROM', start):
+                    self.set_header(data[start:end])
+                start = end + 1
+            if start >= len(data):
+                return
+            self.in_header = False
+            data = data[start:]
+        self.add_records(data.strip(b'\n'))
+
+    """Split records into the columns the summary needs
+    Usually every record has the same number of fields, and the whole
+    block is split into one flat list of fields in a single call; column
+    i is then the slice [i::width]. Every record after the first keeps
+    the newline before it at the start of its first field, which is also
+    how the layout is checked. Blocks with ragged or blank records are
+    split record by record and padded instead.
+    Returns (number of records, columns).
+    """
+    def split_columns(self, data):
+        needed = STANDARD_COLUMNS + len(self.annotation_columns)
+        records = data.count(b'\n') + 1
+        first_end = data.find(b'\n')
+        width = data.count(b'\t', 0, len(data) if first_end == -1 else first_end) + 1
+
+        fields = data.replace(b'\n', b'\t\n').split(b'\t')
+        if len(fields) == records * width and \
+            sum(map(methodcaller('startswith', b'\n'), fields[width::width])) == records - 1:
+            return records, [fields[i::width] if i < width else [b''] * records
+                for i in range(needed)]
+
+        rows = [record.split(b'\t') for record in data.split(b'\n') if record]
+        columns = list(zip_longest(*rows, fillvalue=b''))[:needed]
+        columns += [[b''] * len(rows)] * (needed - len(columns))
+        return len(rows), columns
+
+    def add_records(self, data):
+        if not data:
+            return
+        records, columns = self.split_columns(data)
+        chroms, refs, alts, filters, info = (columns[0], columns[3], columns[4],
+            columns[6], columns[7])
+
+        self.variants += records
+        chromosomes = Counter(chroms)
+        for chrom in [chrom for chrom in chromosomes if chrom.startswith(b'\n')]:
+            chromosomes[chrom[1:]] += chromosomes.pop(chrom)
+        self.chromosomes.update(chromosomes)
+        self.filters.update(filters)
+
+        # Plain base sequences are typed by their lengths; the rest are
+        # multiallelic (comma separated) or symbolic/missing ALTs
+        simple = array.array('b', map(bytes.isalpha, alts))
+        lengths = Counter(zip(map(len, compress(refs, simple)), map(len, compress(alts, simple))))
+        for (ref_length, alt_length), count in lengths.items():
+            self.types[variant_type(ref_length, alt_length)] += count
+        others = list(compress(alts, map(not_, simple)))
+        multiallelic = sum(map(bytes.__contains__, others, repeat(b',')))
+        self.types['MULTIALLELIC'] += multiallelic
+        self.types['OTHER'] += len(others) - multiallelic
+
+        # INFO keys, counted over the whole column in one split
+        keys = Counter(map(itemgetter(0), map(methodcaller('partition', b'='),
+            b';'.join(info).split(b';'))))
+        del keys[b'.']
+        del keys[b'']
+        self.annotations.update(keys)
+
+        for name, column in zip(self.annotation_columns, columns[STANDARD_COLUMNS:]):
+            self.annotations[name] += len(column) - column.count(b'.') - column.count(b'')
+
+    """The summary as plain counts, at most max_keys per breakdown
+    """
+    def to_dict(self, max_keys=50):
+        def decoded(counter):
+            return Counter({key.decode('utf-8', 'replace') if isinstance(key, bytes) else key: count
+                for key, count in counter.items()})
+        return {
+            'variants': self.variants,
+            'chromosomes': top(decoded(self.chromosomes), max_keys),
+            'types': dict(self.types),
+            'filters': top(decoded(self.filters), max_keys),
+            'annotations': top(decoded(self.annotations), max_keys)
+        }
+
+"""Summarize the VCF file at path, reading block_size bytes at a time
+"""
+def summarize(path, block_size=8 * MB, max_keys=50):
+    summary = VcfSummary()
+    tail = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = tail + block
+            end = block.rfind(b'\n')
+            if end == -1:
+                tail = block
+                continue
+            tail = block[end + 1:]
+            summary.add_lines(block[:end])
+    if tail:
+        summary.add_lines(tail)
+    return summary.to_dict(max_keys)
+
+### EOF
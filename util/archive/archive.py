@@ -9,14 +9,19 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
+import time
 import boto3
 import json
+import threading
 
 from botocore import exceptions
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import cold_storage
+import job_stats
+from consumer import QueueConsumer
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -24,106 +29,201 @@ config = SafeConfigParser(os.environ)
 config.read('archive_config.ini')
 
 s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
-db = boto3.client('dynamodb', region_name=config['aws']['AwsRegionName'])
-sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
-glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
-
-# Add utility code here
-def archive():
-    while True:
-        response = sqs.receive_message(
-            QueueUrl=config['aws']['AwsSQSArchiveUrl'],
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=10
-        )
-        try:
-            message = response['Messages'][0]
-            receipt_handle = message['ReceiptHandle']
-            data = json.loads(message['Body'])
-        
-        except KeyError:
-            # Empty queue
-            continue
-        
-        # Getting information from body of message
-        user_id = data['user_id']
-        job_id = data['job_id']
-        s3_key_result_file = data['s3_key_result_file']
-
-        # Premium users' files should not be archived
-        profile = helpers.get_user_profile(id=user_id)
-        if profile['role'] == 'premium_user':
-            sqs.delete_message(
-                QueueUrl=config['aws']['AwsSQSArchiveUrl'],
-                ReceiptHandle=receipt_handle
-            )
-            continue
+dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+backend = cold_storage.create_backend(config)
+stats = job_stats.JobStats(config)
 
-        try:
-            # Getting information from file in the S3 bucket
-            response = s3.get_object(
-                Bucket=config['aws']['AwsS3ResultsBucket'],
-                Key=s3_key_result_file)
-            file_body = response['Body'].read()
-        except exceptions.ClientError as e: 
-            print('Error getting results file from S3: {}'.format(s3_key_result_file))
-            continue
-
-        # Uploading file to Glacier Vault
-        # Source: https://docs.aws.amazon.com/cli/latest/reference/glacier/upload-archive.html
-        response = glacier.upload_archive(
-            vaultName=config['aws']['AwsGlacierVault'],
-            body = file_body)
-
-        archive_id = response['archiveId']
+"""Move one user's pending results to cold storage
+With the Glacier backend the results are written as a single bundle
+archive; see cold_storage.py.
+"""
+def archive_bundle(user_id, entries):
+    # Premium users' files should not be archived
+    profile = helpers.get_user_profile(id=user_id)
+    if profile['role'] == 'premium_user':
+        for entry in entries:
+            consumer.delete(entry['receipt_handle'])
+        return
 
+    bucket = config['aws']['AwsS3ResultsBucket']
+    members = []
+    for entry in entries:
         try:
-            # Updating Dynamo table (removing s3_key_result_file from DynamoTable)
-            db.update_item(
-                TableName=config['aws']['AwsDynamoTable'], 
-                Key={'job_id': {'S': job_id}}, 
-                ExpressionAttributeValues={
-                    ':id': {'S': archive_id}
-                }, 
-                UpdateExpression='SET archive_id = :id REMOVE s3_key_result_file'
-            )
-        
+            head = s3.head_object(Bucket=bucket, Key=entry['s3_key_result_file'])
+            members.append(dict(entry, size=head['ContentLength']))
         except exceptions.ClientError as e:
-            print({
-                'code': 500,
-                'status': 'error',
-                'message': 'Dynamo table could not be updated: {}'.format(str(e))
-            })
-            continue
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                # Throttled, denied or unavailable; try again later
+                print('Error getting results file from S3: {}: {}'.format(
+                    entry['s3_key_result_file'], str(e)))
+                consumer.release(entry['receipt_handle'])
+                continue
+            # Already archived by an earlier attempt; nothing left to do
+            print('Results file no longer in S3: {}'.format(entry['s3_key_result_file']))
+            consumer.delete(entry['receipt_handle'])
+    if not members:
+        return
+
+    start = time.time()
+    try:
+        archived, bytes_moved = backend.archive(user_id, members)
+    except exceptions.ClientError as e:
+        print({
+            'code': 500,
+            'status': 'error',
+            'message': 'Results could not be archived: {}'.format(str(e))
+        })
+        release(members)
+        return
+
+    sizes = {entry['job_id']: entry['size'] for entry in members}
+    counted = {'count': 0, 'size': 0, 'restored': 0}
+    updated = {}
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    try:
+        # Updating Dynamo table (removing s3_key_result_file from DynamoTable)
+        for job_id, attributes in archived.items():
+            attributes = dict(attributes, archive_backend=backend.name, result_size=sizes[job_id])
+            old = table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='SET ' + ', '.join('{0} = :{0}'.format(name) for name in attributes) +
+                    ' REMOVE s3_key_result_file',
+                ExpressionAttributeValues={':' + name: value for name, value in attributes.items()},
+                ReturnValues='ALL_OLD'
+            ).get('Attributes', {})
+            updated[job_id] = (attributes, old)
+            # Only count results that were still in S3 before this update
+            if 's3_key_result_file' in old:
+                counted['count'] += 1
+                counted['size'] += sizes[job_id]
+                counted['restored'] += old.get('storage_status') == 'RESTORED'
 
+    except exceptions.ClientError as e:
+        print({
+            'code': 500,
+            'status': 'error',
+            'message': 'Dynamo table could not be updated: {}'.format(str(e))
+        })
+        # Undo the jobs already pointed at the new archive, then the
+        # archive itself, so the retry does not leave an orphan behind.
+        # Archiving in place (S3 storage class) is simply redone.
+        if backend.deletes_source and unarchive_jobs(table, updated):
+            backend.discard(archived)
+        release(members)
+        return
+
+    if backend.deletes_source:
         try:
-            # Deleting file from S3 bucket
-            s3.delete_object(
-                Bucket=config['aws']['AwsS3ResultsBucket'],
-                Key=s3_key_result_file
+            # Deleting files from S3 bucket
+            s3.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': entry['s3_key_result_file']} for entry in members],
+                    'Quiet': True}
             )
-        
+
         except exceptions.ClientError as e:
             print({
                 'code': 500,
                 'status': 'error',
-                'message': 'File could not be deleted from S3 Bucket: {}'.format(str(e))
+                'message': 'Files could not be deleted from S3 Bucket: {}'.format(str(e))
             })
-            continue
+            release(members)
+            return
+
+    stats.archived(user_id, counted['count'], counted['size'], restored=counted['restored'])
+    for entry in members:
+        consumer.delete(entry['receipt_handle'])
+    helpers.put_metric('ArchiveBytesMoved', bytes_moved, unit='Bytes',
+        dimensions={'Backend': backend.name})
+    print('Archived {} results for {} with {}: {} bytes moved in {:.1f}s'.format(
+        len(members), user_id, backend.name, bytes_moved, time.time() - start))
 
+"""Put job items back as they were before a failed archive
+Returns False if any could not be restored; those still point at the
+new archive, which must then be kept.
+"""
+def unarchive_jobs(table, updated):
+    succeeded = True
+    for job_id, (attributes, old) in updated.items():
+        names = list(attributes) + ['s3_key_result_file']
+        restore = [name for name in names if name in old]
+        remove = [name for name in names if name not in old]
+        values = {':' + name: old[name] for name in restore}
+        values[':new_archive_id'] = attributes['archive_id']
         try:
-            # Deleting message from queue
-            sqs.delete_message(
-                QueueUrl=config['aws']['AwsSQSArchiveUrl'],
-                ReceiptHandle =receipt_handle
+            table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression=' '.join(part for part in (
+                    'SET ' + ', '.join('{0} = :{0}'.format(name) for name in restore) if restore else '',
+                    'REMOVE ' + ', '.join(remove) if remove else '') if part),
+                ConditionExpression='archive_id = :new_archive_id',
+                ExpressionAttributeValues=values
             )
-        
-        except exceptions.ClientError:
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                continue
             print({
                 'code': 500,
                 'status': 'error',
-                'message': 'SQS Archive message could not be deleted from S3 Bucket: {}'.format(str(e))
+                'message': 'Job {} could not be restored after a failed archive: {}'.format(job_id, str(e))
             })
+            succeeded = False
+    return succeeded
+
+"""Bundle the results again later
+"""
+def release(entries):
+    for entry in entries:
+        consumer.release(entry['receipt_handle'])
+
+# Results waiting to be bundled, per user
+pending = {}
+pending_lock = threading.Lock()
+
+"""Add one result to its user's pending bundle
+The message stays hidden (the consumer's visibility timeout covers the
+bundle window) and is deleted once the bundle is written.
+"""
+def receive_result(message):
+    # Getting information from body of message
+    data = json.loads(message['Body'])
+    with pending_lock:
+        entries = pending.setdefault(data['user_id'], [])
+        for entry in entries:
+            if entry['job_id'] == data['job_id']:
+                # Redelivery of a result already in the bundle: SQS only
+                # accepts the newest receipt handle, so the bundle keeps
+                # that one and deletes or releases it with the rest
+                entry['receipt_handle'] = message['ReceiptHandle']
+                return None
+        entries.append({
+            'job_id': data['job_id'],
+            's3_key_result_file': data['s3_key_result_file'],
+            'receipt_handle': message['ReceiptHandle'],
+            'received': time.time()
+        })
+    return None
+
+"""Write the bundles that are full or whose window has closed
+"""
+def write_due_bundles(everything=False):
+    window = config.getint('bundle', 'WindowSeconds')
+    max_members = config.getint('bundle', 'MaxMembers')
+    now = time.time()
+    with pending_lock:
+        due = [user_id for user_id, entries in pending.items()
+            if everything or len(entries) >= max_members or entries[0]['received'] + window <= now]
+        bundles = [(user_id, pending.pop(user_id)) for user_id in due]
+    for user_id, entries in bundles:
+        consumer.submit(archive_bundle, user_id, entries)
+
+"""On shutdown, write every pending bundle rather than leave it waiting
+"""
+def write_all_bundles():
+    write_due_bundles(everything=True)
 
-archive()
+consumer = QueueConsumer(config, config['aws']['AwsSQSArchiveUrl'], receive_result, 'archive',
+    tick=write_due_bundles, drain=write_all_bundles,
+    visibility_timeout=config.getint('bundle', 'WindowSeconds') + config.getint('bundle', 'HoldMarginSeconds'))
+consumer.run()
 # EOF
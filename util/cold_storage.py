@@ -0,0 +1,455 @@
+# cold_storage.py
+#
+# Cold storage backends for archived results
+# Both backends share one interface used by the archive, restore and thaw
+# utilities:
+#   archive(user_id, entries)    -> ({job_id: job attributes}, bytes_moved)
+#   plan_restore(user_id, items) -> [retrieval], each covering some job_ids
+#   start_retrieval(retrieval)   -> retrieval (job) ID
+#   retrieval_id(notification)   -> the retrieval a notification is for
+#   thaw(notification, record, tracker, on_restored) -> bytes_moved
+# bytes_moved counts the bytes that passed through this host. Backends
+# that copy results out of S3 (deletes_source) also have
+#   discard(archived)            -> deletes what archive() wrote
+#
+##
+
+import time
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore import exceptions
+from botocore.config import Config
+
+import glacier as glacier_upload
+
+"""Copy size bytes (or the rest) of a stream into an S3 object, a part at a time
+Small objects are a single put_object; larger ones a multipart upload
+that holds one part in memory. Returns the number of bytes copied.
+"""
+def stream_to_s3(s3, bucket, key, stream, part_size, size=None):
+    def next_part():
+        want = part_size if size is None else min(part_size, size - copied)
+        return glacier_upload.read_exactly(stream, want) if want > 0 else b''
+
+    copied = 0
+    data = next_part()
+    if len(data) < part_size or (size is not None and len(data) == size):
+        s3.put_object(Body=data, Bucket=bucket, Key=key)
+        return len(data)
+
+    # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/create_multipart_upload.html
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    parts = []
+    try:
+        while data:
+            response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                PartNumber=len(parts) + 1, Body=data)
+            parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+            copied += len(data)
+            data = next_part()
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return copied
+
+"""Raised when Glacier job output does not match its tree hash
+"""
+class ChecksumMismatch(Exception):
+    pass
+
+"""Results bundled per user into Glacier vault archives
+The utils host streams every result out of S3 and into Glacier, and back
+again on thaw. See glacier.py for the upload and byte range helpers.
+"""
+class GlacierBackend(object):
+    name = 'glacier'
+    # Results are copied out of S3, so the originals must be deleted
+    deletes_source = True
+
+    def __init__(self, config):
+        self.config = config
+        region = config['aws']['AwsRegionName']
+        self.s3 = boto3.client('s3', region_name=region)
+        # Adaptive retries slow every caller down when Glacier throttles
+        self.glacier = boto3.client('glacier', region_name=region,
+            config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}))
+        self.bundles = boto3.resource('dynamodb', region_name=region).Table(
+            config['aws']['AwsDynamoBundlesTable'])
+
+    """Write the results as one concatenated archive with a manifest
+    """
+    def archive(self, user_id, entries):
+        bucket = self.config['aws']['AwsS3ResultsBucket']
+
+        def opener(key):
+            return lambda: self.s3.get_object(Bucket=bucket, Key=key)['Body']
+
+        stream = glacier_upload.ConcatStream(
+            [(entry['job_id'], opener(entry['s3_key_result_file'])) for entry in entries])
+        # Upload to the Glacier Vault part by part, so only a few parts
+        # are ever held in memory however large the bundle is
+        archive_id, archive_size, checksum = glacier_upload.upload_stream(
+            self.glacier, self.config['aws']['AwsGlacierVault'], stream,
+            part_size=self.config.getint('glacier', 'PartSizeMB') * glacier_upload.MB,
+            parallelism=self.config.getint('glacier', 'UploadParallelism'),
+            description='{}{}/bundle'.format(self.config['aws']['AwsS3Prefix'], user_id))
+
+        offsets = {job_id: (offset, size) for job_id, offset, size in stream.offsets}
+        # The manifest is written before any job item points at it
+        self.bundles.put_item(Item={
+            'archive_id': archive_id,
+            'user_id': user_id,
+            'archive_size': archive_size,
+            'checksum': checksum,
+            'create_time': int(time.time()),
+            'members': [{
+                'job_id': entry['job_id'],
+                's3_key_result_file': entry['s3_key_result_file'],
+                'offset': offsets[entry['job_id']][0],
+                'size': offsets[entry['job_id']][1]
+            } for entry in entries]
+        })
+
+        archived = {job_id: {
+            'archive_id': archive_id,
+            'archive_offset': offset,
+            'archive_size': size
+        } for job_id, (offset, size) in offsets.items()}
+        # Read from S3 once and sent to Glacier once
+        return archived, 2 * archive_size
+
+    """Start a planned retrieval in its planned tier
+    Expedited falls back to Standard when there is no Expedited capacity.
+    Returns the Glacier job ID.
+    """
+    def start_retrieval(self, retrieval):
+        parameters = {
+            'Type': 'archive-retrieval',
+            'ArchiveId': retrieval['archive_id'],
+            'Description': retrieval['description'],
+            'SNSTopic': self.config['aws']['AwsSNSThawARN'],
+            'Tier': retrieval.get('tier', 'Expedited')
+        }
+        if retrieval['byte_range'] is not None:
+            parameters['RetrievalByteRange'] = '{}-{}'.format(*retrieval['byte_range'])
+
+        try:
+            # Source: https://docs.aws.amazon.com/cli/latest/reference/glacier/initiate-job.html
+            return self.glacier.initiate_job(
+                vaultName=self.config['aws']['AwsGlacierVault'],
+                jobParameters=parameters
+            )['jobId']
+
+        # Source: https://botocore.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/exceptions/InsufficientCapacityException.html
+        except self.glacier.exceptions.InsufficientCapacityException:
+            # Standard Glacier job if there's limited capacity
+            parameters['Tier'] = retrieval['tier'] = 'Standard'
+            return self.glacier.initiate_job(
+                vaultName=self.config['aws']['AwsGlacierVault'],
+                jobParameters=parameters
+            )['jobId']
+
+    """Retrievals for the requested jobs in one bundle archive
+    If every result in the bundle is wanted the whole archive is retrieved,
+    otherwise only the (MB-aligned) byte ranges holding the wanted results
+    """
+    def plan_bundle(self, user_id, archive_id, job_ids):
+        bundle = self.bundles.get_item(Key={'archive_id': archive_id})['Item']
+        description = '{}{}/bundle'.format(self.config['aws']['AwsS3Prefix'], user_id)
+        archive_size = int(bundle['archive_size'])
+
+        members = [member for member in bundle['members'] if member['job_id'] in job_ids]
+        if len(members) == len(bundle['members']):
+            return [{
+                'archive_id': archive_id,
+                'description': description,
+                'byte_range': None,
+                'job_ids': [member['job_id'] for member in members],
+                'targets': {member['job_id']: member['s3_key_result_file'] for member in members},
+                'size': archive_size
+            }]
+
+        member_ranges = [(glacier_upload.aligned_range(int(member['offset']),
+            int(member['size']), archive_size), member) for member in members]
+        retrievals = []
+        for start, end in glacier_upload.merge_ranges([r for r, _ in member_ranges]):
+            covered = [member for (s, e), member in member_ranges if start <= s and e <= end]
+            retrievals.append({
+                'archive_id': archive_id,
+                'description': description,
+                'byte_range': (start, end),
+                'job_ids': [member['job_id'] for member in covered],
+                'targets': {member['job_id']: member['s3_key_result_file'] for member in covered},
+                'size': end - start + 1
+            })
+        return retrievals
+
+    """Group archived job items into the retrievals that restore them
+    Results archived in bundles are grouped so each bundle is retrieved
+    once (or once per byte range)
+    """
+    def plan_restore(self, user_id, items):
+        bundles = {}
+        retrievals = []
+        for item in items:
+            if 'archive_offset' in item:
+                bundles.setdefault(item['archive_id'], set()).add(item['job_id'])
+                continue
+
+            # Archived one file per archive, before bundling
+            file = item['s3_key_input_file'].split('.')[0]
+            filename = '{}{}/{}.annot.vcf'.format(self.config['aws']['AwsS3Prefix'], user_id, file)
+            retrievals.append({
+                'archive_id': item['archive_id'],
+                'description': filename,
+                'byte_range': None,
+                'job_ids': [item['job_id']],
+                'targets': {item['job_id']: filename},
+                'size': None
+            })
+
+        for archive_id, job_ids in bundles.items():
+            retrievals.extend(self.plan_bundle(user_id, archive_id, job_ids))
+        return retrievals
+
+    def retrieval_id(self, notification):
+        return notification['JobId']
+
+    """Unpack a completed retrieval back into the results bucket
+    Members of a bundle are read from the job output in offset order and
+    each one is written back to its original S3 key. Once the output read
+    has been verified, the members copied are checkpointed in the
+    retrieval record; a thaw that finds earlier checkpoints resumes from
+    the first member not yet copied, reading only the rest of the output.
+    The archive is deleted once every member has been restored.
+    """
+    def thaw(self, notification, record, tracker, on_restored):
+        retrieval_id = notification['JobId']
+        archive_id = notification['ArchiveId']
+        bucket = self.config['aws']['AwsS3ResultsBucket']
+        part_size = self.config.getint('thaw', 'PartSizeMB') * glacier_upload.MB
+
+        def job_output(output_range=None):
+            # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
+            kwargs = {'range': 'bytes={}-{}'.format(*output_range)} if output_range else {}
+            job = self.glacier.get_job_output(
+                accountId='-',
+                vaultName=self.config['aws']['AwsGlacierVault'],
+                jobId=retrieval_id,
+                **kwargs
+            )
+            # Glacier only returns a checksum for tree-hash aligned output
+            return job, glacier_upload.HashingStream(job['body'])
+
+        bundle = self.bundles.get_item(Key={'archive_id': archive_id}).get('Item')
+        if bundle is None and (notification.get('JobDescription', '').endswith('/bundle') or
+            (record is not None and (record.get('byte_range') or len(record['targets']) > 1))):
+            # A bundle whose manifest is gone was fully restored (and
+            # deleted) by another retrieval, e.g. a bulk restore that beat
+            # a priority one; this output may span several members, so it
+            # must not be written anywhere
+            print('Bundle {} was already restored; dropping retrieval {}'.format(archive_id, retrieval_id))
+            return 0
+        if bundle is None:
+            # Archived one file per archive, before bundling
+            if record is not None:
+                job_id, filename = list(record['targets'].items())[0]
+            else:
+                # Retrieval started before tracking; the key is the description
+                filename = notification['JobDescription']
+                job_id = filename[filename.rfind('/') + 1:filename.find('~')]
+            job, body = job_output()
+            copied = stream_to_s3(self.s3, bucket, filename, body, part_size)
+            self.verify(job, body, [filename])
+            on_restored(job_id, filename)
+            self.delete_archive(archive_id)
+            return 2 * copied
+
+        byte_range = notification.get('RetrievalByteRange') or \
+            '0-{}'.format(int(bundle['archive_size']) - 1)
+        start, end = (int(n) for n in byte_range.split('-'))
+        done = set(record.get('copied', [])) if record is not None else set()
+        members = [member for member in sorted(bundle['members'], key=lambda member: int(member['offset']))
+            if int(member['offset']) >= start and int(member['offset']) + int(member['size']) - 1 <= end]
+        remaining = [member for member in members if member['job_id'] not in done]
+
+        position = first = start
+        copied = []
+        if remaining:
+            # Resume from the MB boundary before the first member not copied
+            position = start + (int(remaining[0]['offset']) - start) // glacier_upload.MB * glacier_upload.MB
+            job, body = job_output((position - start, end - start) if position > start else None)
+            first = position
+            for member in remaining:
+                offset, size = int(member['offset']), int(member['size'])
+                glacier_upload.skip_bytes(body, offset - position)
+                stream_to_s3(self.s3, bucket, member['s3_key_result_file'], body, part_size, size=size)
+                position = offset + size
+                copied.append(member['s3_key_result_file'])
+
+            # Only output known to be good is checkpointed, and jobs only
+            # point at their restored files once it is; a mismatch raises
+            # here with nothing recorded, so the retry copies them again
+            self.verify(job, body, copied)
+            if tracker is not None and record is not None:
+                tracker.checkpoint(retrieval_id, [member['job_id'] for member in remaining])
+
+        for member in members:
+            on_restored(member['job_id'], member['s3_key_result_file'])
+
+        if members:
+            response = self.bundles.update_item(Key={'archive_id': archive_id},
+                UpdateExpression="ADD restored_jobs :r",
+                ExpressionAttributeValues={':r': set(member['job_id'] for member in members)},
+                ReturnValues="ALL_NEW"
+            )
+            if len(response['Attributes']['restored_jobs']) >= len(bundle['members']):
+                self.delete_archive(archive_id)
+                self.bundles.delete_item(Key={'archive_id': archive_id})
+        # Read from Glacier once and sent to S3 once
+        return 2 * (position - first) if copied else 0
+
+    """Check the job output against Glacier's tree hash, if it gave one
+    On a mismatch the files just written are removed; the job output stays
+    available, so the thaw can be retried.
+    """
+    def verify(self, job, body, keys):
+        if not job.get('checksum'):
+            return
+        checksum = body.finish()
+        if checksum != job['checksum']:
+            if keys:
+                self.s3.delete_objects(
+                    Bucket=self.config['aws']['AwsS3ResultsBucket'],
+                    Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+                )
+            raise ChecksumMismatch('Job output tree hash {} does not match {}'.format(
+                checksum, job['checksum']))
+
+    """Throw away archives written by archive() that no job points at
+    """
+    def discard(self, archived):
+        for archive_id in set(attributes['archive_id'] for attributes in archived.values()):
+            self.delete_archive(archive_id)
+            self.bundles.delete_item(Key={'archive_id': archive_id})
+
+    def delete_archive(self, archive_id):
+        # Source: https://docs.aws.amazon.com/cli/latest/reference/glacier/delete-archive.html
+        try:
+            self.glacier.delete_archive(
+                accountId='-',
+                vaultName=self.config['aws']['AwsGlacierVault'],
+                archiveId=archive_id
+            )
+        except exceptions.ClientError as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Glacier Error: {}'.format(str(e))
+            })
+
+"""Results left in the results bucket under a cold S3 storage class
+Archiving is a server-side copy of each object onto itself with the new
+storage class, so no result bytes pass through the utils host. Restore
+uses S3 object restore; the bucket's s3:ObjectRestore:Completed events
+go to the thaw topic, and thaw copies the object back to STANDARD.
+"""
+class S3StorageClassBackend(object):
+    name = 's3'
+    # Results stay at their original key
+    deletes_source = False
+
+    def __init__(self, config):
+        self.config = config
+        self.s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+
+    """Server-side copy of an object onto itself with a new storage class
+    The managed copy switches to multipart UploadPartCopy for large objects
+    """
+    def change_storage_class(self, key, storage_class):
+        bucket = self.config['aws']['AwsS3ResultsBucket']
+        self.s3.copy(
+            CopySource={'Bucket': bucket, 'Key': key},
+            Bucket=bucket,
+            Key=key,
+            ExtraArgs={'StorageClass': storage_class, 'MetadataDirective': 'COPY'}
+        )
+
+    def archive(self, user_id, entries):
+        archived = {}
+        for entry in entries:
+            self.change_storage_class(entry['s3_key_result_file'],
+                self.config['archive']['StorageClass'])
+            archived[entry['job_id']] = {'archive_id': entry['s3_key_result_file']}
+        return archived, 0
+
+    def plan_restore(self, user_id, items):
+        return [{
+            'archive_id': item['archive_id'],
+            'job_ids': [item['job_id']],
+            'targets': {item['job_id']: item['archive_id']},
+            'size': None
+        } for item in items]
+
+    """Start an object restore; returns the key, as S3 has no job ID
+    """
+    def start_retrieval(self, retrieval):
+        bucket = self.config['aws']['AwsS3ResultsBucket']
+        request = {
+            'Days': self.config.getint('archive', 'RestoreDays'),
+            'GlacierJobParameters': {'Tier': retrieval.get('tier', 'Expedited')}
+        }
+        try:
+            # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/restore_object.html
+            try:
+                self.s3.restore_object(Bucket=bucket, Key=retrieval['archive_id'],
+                    RestoreRequest=request)
+            except exceptions.ClientError as e:
+                # Deep Archive has no Expedited tier, and Expedited
+                # capacity is not always available
+                if request['GlacierJobParameters']['Tier'] != 'Expedited' or \
+                    e.response['Error']['Code'] not in ('GlacierExpeditedRetrievalNotAvailable', 'InvalidArgument'):
+                    raise
+                request['GlacierJobParameters']['Tier'] = retrieval['tier'] = 'Standard'
+                self.s3.restore_object(Bucket=bucket, Key=retrieval['archive_id'],
+                    RestoreRequest=request)
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'RestoreAlreadyInProgress':
+                raise
+        return retrieval['archive_id']
+
+    def retrieval_id(self, notification):
+        return unquote_plus(notification['Records'][0]['s3']['object']['key'])
+
+    def thaw(self, notification, record, tracker, on_restored):
+        for event in notification['Records']:
+            key = unquote_plus(event['s3']['object']['key'])
+            if record is not None and key in record['targets'].values():
+                job_id = [job for job, target in record['targets'].items() if target == key][0]
+            else:
+                # Restore started before tracking
+                job_id = key[key.rfind('/') + 1:key.find('~')]
+            # The restored copy is temporary; make it permanent
+            self.change_storage_class(key, 'STANDARD')
+            on_restored(job_id, key)
+        return 0
+
+BACKENDS = {
+    GlacierBackend.name: GlacierBackend,
+    S3StorageClassBackend.name: S3StorageClassBackend
+}
+
+"""The backend that archives new results, from [archive] Backend
+"""
+def create_backend(config):
+    return BACKENDS[config['archive']['Backend']](config)
+
+"""Every backend, by name; archived items record the one that holds them
+"""
+def create_backends(config):
+    return {name: backend(config) for name, backend in BACKENDS.items()}
+
+### EOF
@@ -0,0 +1,224 @@
+# consumer.py
+#
+# Queue consumer runtime shared by the util daemons
+# Receives SQS messages in batches, hands each to a handler on a worker
+# pool, deletes finished messages in batches and releases failed ones
+# for a retry after a short delay. SIGTERM/SIGINT stop the receiving and
+# let in-flight messages drain. Per-queue throughput, handler latency and
+# failed deletes and releases are published to CloudWatch every
+# MetricsSeconds.
+#
+# A handler returns True when the message is done (it is deleted), False
+# to have it retried, or None when it keeps the message itself and later
+# calls consumer.delete() or consumer.release() with its receipt handle.
+#
+##
+
+import time
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore import exceptions
+
+import helpers
+
+class QueueConsumer(object):
+    def __init__(self, config, queue_url, handler, name, tick=None, drain=None,
+        workers=None, visibility_timeout=None):
+        self.queue_url = queue_url
+        self.handler = handler
+        self.name = name
+        # tick() runs between receives, drain() once receiving has stopped
+        self.tick = tick
+        self.drain = drain
+        self.workers = workers or config.getint('consumer', 'Workers')
+        self.batch_size = min(10, config.getint('consumer', 'BatchSize'))
+        self.wait_seconds = config.getint('consumer', 'WaitSeconds')
+        self.retry_delay = config.getint('consumer', 'RetryDelaySeconds')
+        self.metrics_seconds = config.getint('consumer', 'MetricsSeconds')
+        self.visibility_timeout = visibility_timeout
+
+        self.sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+        self.slots = threading.Semaphore(self.workers)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.to_delete = []
+        self.to_release = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'received': 0, 'succeeded': 0, 'failed': 0, 'latency': 0.0, 'max_latency': 0.0,
+            'delete_failed': 0, 'release_failed': 0}
+        self.stats_since = time.time()
+
+    """Delete a finished message (batched)
+    """
+    def delete(self, receipt_handle):
+        with self.lock:
+            self.to_delete.append(receipt_handle)
+
+    """Make a message visible again after RetryDelaySeconds (batched)
+    """
+    def release(self, receipt_handle):
+        with self.lock:
+            self.to_release.append(receipt_handle)
+
+    """Run fn on the worker pool, waiting for a free worker
+    """
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        self.executor.submit(self.run_task, fn, *args)
+
+    def run_task(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print('Unexpected error in {} worker: {}'.format(self.name, str(e)))
+        finally:
+            self.slots.release()
+
+    def handle(self, message):
+        start = time.time()
+        try:
+            done = self.handler(message)
+        except Exception as e:
+            print('Unexpected error handling {} message: {}'.format(self.name, str(e)))
+            done = False
+        elapsed = time.time() - start
+
+        if done is True:
+            self.delete(message['ReceiptHandle'])
+        elif done is False:
+            self.release(message['ReceiptHandle'])
+        with self.lock:
+            self.stats['succeeded' if done is not False else 'failed'] += 1
+            self.stats['latency'] += elapsed
+            self.stats['max_latency'] = max(self.stats['max_latency'], elapsed)
+
+    """Send the pending deletes and releases, ten per request
+    Entries SQS failed on its side are queued for the next flush; ones it
+    rejected (e.g. an expired receipt handle) are only logged and counted.
+    """
+    def flush(self):
+        with self.lock:
+            to_delete, self.to_delete = self.to_delete, []
+            to_release, self.to_release = self.to_release, []
+
+        retry_delete = self.send_batches(self.sqs.delete_message_batch, to_delete,
+            'deleted', 'delete_failed')
+        retry_release = self.send_batches(self.sqs.change_message_visibility_batch, to_release,
+            'released', 'release_failed', {'VisibilityTimeout': self.retry_delay})
+        with self.lock:
+            self.to_delete.extend(retry_delete)
+            self.to_release.extend(retry_release)
+
+    """Call one of the SQS batch actions on handles, ten at a time
+    Returns the handles worth retrying.
+    """
+    def send_batches(self, action, handles, verb, counter, extra=None):
+        retry = []
+        for i in range(0, len(handles), 10):
+            batch = handles[i:i + 10]
+            try:
+                # Source: https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessageBatch.html
+                response = action(
+                    QueueUrl=self.queue_url,
+                    Entries=[dict(extra or {}, Id=str(n), ReceiptHandle=handle)
+                        for n, handle in enumerate(batch)]
+                )
+            except exceptions.ClientError as e:
+                print('{} messages could not be {}: {}'.format(self.name, verb, str(e)))
+                with self.lock:
+                    self.stats[counter] += len(batch)
+                continue
+
+            failed = response.get('Failed', [])
+            for failure in failed:
+                print('{} message could not be {}: {} {}'.format(
+                    self.name, verb, failure['Code'], failure.get('Message', '')))
+                if not failure['SenderFault']:
+                    retry.append(batch[int(failure['Id'])])
+            if failed:
+                with self.lock:
+                    self.stats[counter] += len(failed)
+        return retry
+
+    def publish_metrics(self, force=False):
+        elapsed = time.time() - self.stats_since
+        if not force and elapsed < self.metrics_seconds:
+            return
+        with self.lock:
+            stats = self.stats
+            self.reset_stats()
+
+        dimensions = {'Queue': self.name}
+        handled = stats['succeeded'] + stats['failed']
+        helpers.put_metric('MessagesReceived', stats['received'], dimensions=dimensions)
+        helpers.put_metric('MessagesFailed', stats['failed'], dimensions=dimensions)
+        helpers.put_metric('MessagesDeleteFailed', stats['delete_failed'], dimensions=dimensions)
+        helpers.put_metric('MessagesReleaseFailed', stats['release_failed'], dimensions=dimensions)
+        helpers.put_metric('MessagesPerSecond', handled / max(elapsed, 1), unit='Count/Second',
+            dimensions=dimensions)
+        if handled:
+            helpers.put_metric('HandlerLatency', stats['latency'] / handled * 1000,
+                unit='Milliseconds', dimensions=dimensions)
+            helpers.put_metric('HandlerMaxLatency', stats['max_latency'] * 1000,
+                unit='Milliseconds', dimensions=dimensions)
+
+    def stop(self, *args):
+        print('Stopping {} consumer; draining in-flight messages'.format(self.name))
+        self.stopping.set()
+
+    def receive(self):
+        # Only take as many messages as there are free workers; with none
+        # free, return so that deletes and ticks still happen
+        if not self.slots.acquire(timeout=1):
+            return
+        free = 1
+        while free < min(self.workers, self.batch_size) and self.slots.acquire(blocking=False):
+            free += 1
+
+        kwargs = {
+            'QueueUrl': self.queue_url,
+            'MaxNumberOfMessages': free,
+            'WaitTimeSeconds': self.wait_seconds
+        }
+        if self.visibility_timeout is not None:
+            kwargs['VisibilityTimeout'] = self.visibility_timeout
+        try:
+            messages = self.sqs.receive_message(**kwargs).get('Messages', [])
+        except exceptions.ClientError as e:
+            print('{} receive failed: {}'.format(self.name, str(e)))
+            messages = []
+
+        with self.lock:
+            self.stats['received'] += len(messages)
+        for message in messages:
+            self.executor.submit(self.run_task, self.handle, message)
+        for _ in range(free - len(messages)):
+            self.slots.release()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as self.executor:
+            while not self.stopping.is_set():
+                self.receive()
+                if self.tick is not None:
+                    self.tick()
+                self.flush()
+                self.publish_metrics()
+
+            if self.drain is not None:
+                self.drain()
+        # Every worker has finished; the second flush retries what SQS
+        # failed on its side in the first
+        self.flush()
+        self.flush()
+        self.publish_metrics(force=True)
+        print('{} consumer stopped'.format(self.name))
+
+### EOF
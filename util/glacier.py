@@ -0,0 +1,258 @@
+# glacier.py
+#
+# Streaming Glacier helpers shared by the utilities
+# SHA-256 tree hashing and constant-memory multipart archive uploads
+#
+##
+
+import hashlib
+import threading
+from binascii import hexlify
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+
+"""Combine a list of SHA-256 digests into a tree hash (raw bytes)
+Source: https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+"""
+def combine_tree_hashes(hashes):
+    if not hashes:
+        return hashlib.sha256(b'').digest()
+    while len(hashes) > 1:
+        combined = []
+        for i in range(0, len(hashes) - 1, 2):
+            combined.append(hashlib.sha256(hashes[i] + hashes[i + 1]).digest())
+        if len(hashes) % 2:
+            combined.append(hashes[-1])
+        hashes = combined
+    return hashes[0]
+
+"""Incremental tree hash; feed bytes with update(), read with hexdigest()
+Only one 32-byte digest per MB is kept, never the data itself
+"""
+class TreeHash(object):
+    def __init__(self):
+        self.leaves = []
+        self.current = hashlib.sha256()
+        self.current_size = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(MB - self.current_size, len(view))
+            self.current.update(view[:take])
+            self.current_size += take
+            self.size += take
+            view = view[take:]
+            if self.current_size == MB:
+                self.leaves.append(self.current.digest())
+                self.current = hashlib.sha256()
+                self.current_size = 0
+
+    def leaf_digests(self):
+        leaves = list(self.leaves)
+        if self.current_size or not leaves:
+            leaves.append(self.current.digest())
+        return leaves
+
+    def digest(self):
+        return combine_tree_hashes(self.leaf_digests())
+
+    def hexdigest(self):
+        return hexlify(self.digest()).decode('ascii')
+
+"""Tree hash of an in-memory bytes object, as a hex string
+"""
+def tree_hash(data):
+    hasher = TreeHash()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+"""Glacier part sizes must be 1 MB times a power of two, up to 4 GB
+"""
+def check_part_size(part_size):
+    mb = part_size // MB
+    if part_size % MB or mb < 1 or mb > 4096 or mb & (mb - 1):
+        raise ValueError('Glacier part size must be 1 MB times a power of two (got {} bytes)'.format(part_size))
+    return part_size
+
+"""Read exactly size bytes from a file-like stream (fewer only at EOF)
+"""
+def read_exactly(stream, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = stream.read(size - len(buffer))
+        if not chunk:
+            break
+        buffer += chunk
+    return bytes(buffer)
+
+"""Read and discard size bytes from a file-like stream, a part at a time
+"""
+def skip_bytes(stream, size, chunk_size=MB):
+    while size > 0:
+        chunk = stream.read(min(chunk_size, size))
+        if not chunk:
+            break
+        size -= len(chunk)
+
+"""File-like wrapper that tree-hashes everything read through it
+Used to check Glacier job output against the checksum Glacier reports
+without holding the output in memory.
+"""
+class HashingStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.hasher = TreeHash()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hasher.update(chunk)
+        return chunk
+
+    """Hash whatever is left unread; returns the hex tree hash of it all
+    """
+    def finish(self):
+        skip_bytes(self, float('inf'))
+        return self.hasher.hexdigest()
+
+"""File-like object that reads several streams back to back
+Members are opened lazily, one at a time, and the (offset, size) of each
+one within the concatenated stream is recorded in `offsets` as it is read.
+"""
+class ConcatStream(object):
+    def __init__(self, members):
+        # members is a list of (key, open_function) pairs
+        self.members = iter(members)
+        self.offsets = []
+        self.position = 0
+        self.current = None
+
+    def next_member(self):
+        key, open_member = next(self.members, (None, None))
+        if key is None:
+            return False
+        self.current = open_member()
+        self.offsets.append((key, self.position, 0))
+        return True
+
+    def read(self, size):
+        while True:
+            if self.current is None and not self.next_member():
+                return b''
+            chunk = self.current.read(size)
+            if chunk:
+                key, offset, length = self.offsets[-1]
+                self.offsets[-1] = (key, offset, length + len(chunk))
+                self.position += len(chunk)
+                return chunk
+            self.current = None
+
+"""Smallest byte range Glacier will accept that covers [offset, offset + size)
+Ranges must start on a MB boundary and end one byte before a MB boundary
+or at the end of the archive. Returns (start, end), both inclusive.
+Source: https://docs.aws.amazon.com/amazonglacier/latest/dev/api-initiate-job-post.html
+"""
+def aligned_range(offset, size, archive_size):
+    start = offset // MB * MB
+    end = min(-(-(offset + size) // MB) * MB, archive_size) - 1
+    return start, end
+
+"""Merge overlapping or adjacent (start, end) ranges
+"""
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+"""Stream a file-like object into a Glacier archive with multipart upload
+At most `parallelism` parts are in flight at once, so memory use stays
+near (parallelism + 1) * part_size however large the archive is. A
+stream that fits in one part (including an empty one, which a multipart
+upload can't complete with no parts) is uploaded in a single request.
+Returns (archive_id, archive_size, tree_hash).
+"""
+def upload_stream(glacier, vault, stream, part_size=8 * MB, parallelism=4, description=''):
+    check_part_size(part_size)
+    first = read_exactly(stream, part_size)
+    if len(first) < part_size:
+        checksum = tree_hash(first)
+        # Source: https://docs.aws.amazon.com/amazonglacier/latest/dev/api-archive-post.html
+        response = glacier.upload_archive(
+            vaultName=vault,
+            archiveDescription=description,
+            checksum=checksum,
+            body=first
+        )
+        return response['archiveId'], len(first), checksum
+
+    # Source: https://docs.aws.amazon.com/amazonglacier/latest/dev/uploading-archive-mpu.html
+    upload_id = glacier.initiate_multipart_upload(
+        vaultName=vault,
+        archiveDescription=description,
+        partSize=str(part_size)
+    )['uploadId']
+
+    # Parts are whole MBs, so the archive's leaf hashes are just the
+    # parts' leaf hashes in order; each byte is hashed once
+    archive_leaves = []
+    archive_size = 0
+    slots = threading.BoundedSemaphore(parallelism)
+
+    def upload_part(start, data, checksum):
+        try:
+            glacier.upload_multipart_part(
+                vaultName=vault,
+                uploadId=upload_id,
+                range='bytes {}-{}/*'.format(start, start + len(data) - 1),
+                checksum=checksum,
+                body=data
+            )
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = []
+            while True:
+                slots.acquire()
+                # Stop reading as soon as any part has failed
+                for future in futures:
+                    if future.done():
+                        future.result()
+                if first is not None:
+                    # Already read to choose between the two kinds of upload
+                    data, first = first, None
+                else:
+                    data = read_exactly(stream, part_size)
+                if not data:
+                    slots.release()
+                    break
+                part_hash = TreeHash()
+                part_hash.update(data)
+                archive_leaves.extend(part_hash.leaf_digests())
+                futures.append(executor.submit(upload_part, archive_size, data, part_hash.hexdigest()))
+                archive_size += len(data)
+                del data
+            for future in futures:
+                future.result()
+
+        checksum = hexlify(combine_tree_hashes(archive_leaves)).decode('ascii')
+        response = glacier.complete_multipart_upload(
+            vaultName=vault,
+            uploadId=upload_id,
+            archiveSize=str(archive_size),
+            checksum=checksum
+        )
+    except Exception:
+        glacier.abort_multipart_upload(vaultName=vault, uploadId=upload_id)
+        raise
+
+    return response['archiveId'], archive_size, checksum
+
+### EOF
@@ -10,7 +10,9 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
 import boto3
+import threading
 from botocore.exceptions import ClientError
 
 # Get util configuration
@@ -40,6 +42,48 @@ def send_email_ses(recipients=None,
 
   return response
 
+"""Publish a single metric data point to CloudWatch
+Metrics are best-effort; a failure to publish never interrupts the caller
+"""
+def put_metric(name=None, value=1, unit='Count', dimensions=None):
+  cloudwatch = boto3.client('cloudwatch', region_name=config['aws']['AwsRegionName'])
+
+  try:
+    cloudwatch.put_metric_data(
+      Namespace=config['aws']['AwsCloudWatchNamespace'],
+      MetricData=[{
+        'MetricName': name,
+        'Dimensions': [{'Name': k, 'Value': str(v)}
+          for k, v in (dimensions or {}).items()],
+        'Value': value,
+        'Unit': unit
+      }])
+  except ClientError as e:
+    print(f"Unable to publish metric {name}: {e}")
+
+"""Thread-safe limiter allowing `rate` calls per second on average,
+with bursts of up to `burst` calls
+"""
+class RateLimiter(object):
+  def __init__(self, rate, burst=1):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
 
 import psycopg2
 import psycopg2.extras
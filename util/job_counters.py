@@ -0,0 +1,39 @@
+# job_counters.py
+#
+# Layout of the per-user job stats items, shared by the writers here
+# (job_stats.py) and the web server's readers (web/job_stats.py), so the
+# counter names are defined in one place. Plain Python only: the web
+# server imports it without the rest of util.
+#
+##
+
+# Counters kept on every item, next to one jobs_<status> per status
+COUNTERS = ('jobs_total', 'results_stored', 'bytes_stored',
+    'results_archived', 'bytes_archived', 'results_restored')
+STATUSES = ('PENDING', 'RUNNING', 'COMPLETED', 'REJECTED', 'FAILED')
+
+# Jobs waiting for or holding an annotator
+ACTIVE_STATUSES = ('PENDING', 'RUNNING')
+
+"""Counter name for the jobs in one job_status
+"""
+def status_counter(status):
+    return 'jobs_' + status.lower()
+
+"""A stats item as a dict of counters, with the job counts under
+jobs_by_status
+Counters that were never adjusted (or drifted below zero) read as 0.
+"""
+def read_counters(item):
+    counters = {name: max(0, int(item.get(name, 0))) for name in COUNTERS}
+    counters['jobs_by_status'] = {status: max(0, int(item.get(status_counter(status), 0)))
+        for status in STATUSES}
+    counters['updated_time'] = int(item.get('updated_time', 0))
+    return counters
+
+"""Jobs still waiting for or holding an annotator, from read_counters()
+"""
+def active_jobs(counters):
+    return sum(counters['jobs_by_status'][status] for status in ACTIVE_STATUSES)
+
+### EOF
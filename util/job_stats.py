@@ -0,0 +1,140 @@
+# job_stats.py
+#
+# Per-user job aggregates, maintained incrementally
+# One item per user (keyed by user_id) holds counters that the code
+# paths changing a job adjust as they change it, so a summary of a
+# user's jobs is a single get_item instead of a user_id_index query
+# (the names are defined in job_counters.py):
+#
+#   jobs_total                   jobs ever submitted
+#   jobs_<status>                jobs currently in each job_status
+#   results_stored, bytes_stored     results files in S3
+#   results_archived, bytes_archived results in cold storage
+#   results_restored             results thawed back into S3
+#
+# Every adjustment is a single atomic ADD and is best-effort: a failed
+# one is logged, not raised, and the drift it leaves is corrected by the
+# stats utility, which recounts users from their job items.
+##
+
+import time
+
+import boto3
+from botocore import exceptions
+
+from job_counters import COUNTERS, status_counter
+
+class JobStats(object):
+    def __init__(self, config):
+        self.table = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName']).Table(
+            config['aws']['AwsDynamoJobStatsTable'])
+
+    """Add each value in deltas to the user's counter of that name
+    """
+    def adjust(self, user_id, deltas):
+        deltas = {name: value for name, value in deltas.items() if value}
+        if not deltas:
+            return
+        try:
+            self.table.update_item(
+                Key={'user_id': user_id},
+                UpdateExpression='SET updated_time = :t ADD ' + ', '.join(
+                    '{0} :{0}'.format(name) for name in deltas),
+                ExpressionAttributeValues=dict(
+                    {':' + name: value for name, value in deltas.items()},
+                    **{':t': int(time.time())})
+            )
+        except exceptions.ClientError as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Job stats for {} could not be updated: {}'.format(user_id, str(e))
+            })
+
+    def submitted(self, user_id):
+        self.adjust(user_id, {'jobs_total': 1, status_counter('PENDING'): 1})
+
+    def status_changed(self, user_id, old_status, new_status):
+        self.adjust(user_id, {status_counter(old_status): -1, status_counter(new_status): 1})
+
+    """A job finished and its results file (of result_size bytes) is in S3
+    """
+    def completed(self, user_id, old_status, result_size):
+        self.adjust(user_id, {
+            status_counter(old_status): -1,
+            status_counter('COMPLETED'): 1,
+            'results_stored': 1,
+            'bytes_stored': result_size
+        })
+
+    """Results moved from S3 to cold storage; `restored` of them had been
+    thawed before
+    """
+    def archived(self, user_id, count, size, restored=0):
+        self.adjust(user_id, {
+            'results_stored': -count,
+            'bytes_stored': -size,
+            'results_archived': count,
+            'bytes_archived': size,
+            'results_restored': -restored
+        })
+
+    def restored(self, user_id, size):
+        self.adjust(user_id, {
+            'results_archived': -1,
+            'bytes_archived': -size,
+            'results_stored': 1,
+            'bytes_stored': size,
+            'results_restored': 1
+        })
+
+    def get(self, user_id):
+        return self.table.get_item(Key={'user_id': user_id}).get('Item')
+
+    """Replace a user's counters with a recount, unless an adjustment has
+    landed since the recount started (the next recount will include it)
+    Returns False if the item was left alone for that reason.
+    """
+    def replace(self, user_id, counters, counted_since):
+        item = dict(counters, user_id=user_id, updated_time=int(counted_since),
+            reconciled_time=int(time.time()))
+        try:
+            self.table.put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(user_id) OR updated_time < :since',
+                ExpressionAttributeValues={':since': int(counted_since)}
+            )
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    def scan(self):
+        kwargs = {}
+        while True:
+            response = self.table.scan(**kwargs)
+            for item in response['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""Counters for one job item, as the incremental updates would leave them
+"""
+def count_job(item):
+    counters = {'jobs_total': 1}
+    if item.get('job_status'):
+        counters[status_counter(item['job_status'])] = 1
+    size = int(item.get('result_size', 0))
+    if 's3_key_result_file' in item and item.get('job_status') == 'COMPLETED':
+        counters['results_stored'] = 1
+        counters['bytes_stored'] = size
+        if item.get('storage_status') == 'RESTORED':
+            counters['results_restored'] = 1
+    elif 'archive_id' in item:
+        counters['results_archived'] = 1
+        counters['bytes_archived'] = size
+    return counters
+
+### EOF
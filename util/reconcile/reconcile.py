@@ -0,0 +1,163 @@
+# reconcile.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Picks up cold storage retrievals whose completion notification was lost
+# Tracked retrievals that have not been thawed are checked against Glacier
+# (describe_job) or S3 (the object's Restore status). Completed ones are
+# sent to the thaw queue as if notified; failed or expired ones are
+# cleared from their jobs and the user's restore is requested again.
+# Thaws that stopped partway (THAWING with the lease expired or given up)
+# are checked and requeued the same way, and resume from their checkpoints.
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
+
+from botocore import exceptions
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+import retrievals
+
+# Get configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read('reconcile_config.ini')
+
+dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
+tracker = retrievals.RetrievalTracker(config)
+
+"""Raised for a retrieval that failed or whose output has expired
+"""
+class RetrievalGone(Exception):
+    pass
+
+"""The notification thaw would have received, or None if the retrieval is
+still running
+"""
+def glacier_notification(record):
+    try:
+        # Source: https://docs.aws.amazon.com/amazonglacier/latest/dev/api-describe-job-get.html
+        job = glacier.describe_job(
+            accountId='-',
+            vaultName=config['aws']['AwsGlacierVault'],
+            jobId=record['retrieval_id']
+        )
+    except glacier.exceptions.ResourceNotFoundException:
+        raise RetrievalGone('expired')
+    job.pop('ResponseMetadata', None)
+
+    if not job['Completed']:
+        return None
+    if job['StatusCode'] != 'Succeeded':
+        raise RetrievalGone(job.get('StatusMessage') or job['StatusCode'])
+    return job
+
+"""Same for an S3 object restore, from the object's Restore header
+"""
+def s3_notification(record):
+    key = record['retrieval_id']
+    # Source: https://docs.aws.amazon.com/AmazonS3/latest/API/API_HeadObject.html
+    restore = s3.head_object(Bucket=config['aws']['AwsS3ResultsBucket'], Key=key).get('Restore')
+    if not restore:
+        raise RetrievalGone('expired')
+    if 'ongoing-request="true"' in restore:
+        return None
+    return {'Records': [{'s3': {'object': {'key': quote_plus(key)}}}]}
+
+"""Check one tracked retrieval and act on what it says
+"""
+def reconcile_record(record):
+    try:
+        if record['backend'] == 'glacier':
+            notification = glacier_notification(record)
+        else:
+            notification = s3_notification(record)
+    except RetrievalGone as e:
+        forget(record, retrievals.EXPIRED if str(e) == 'expired' else retrievals.FAILED)
+        return 'gone'
+
+    if notification is None:
+        return 'running'
+
+    # Thaw resumes from the record's checkpoints, if it got that far
+    sqs.send_message(
+        QueueUrl=config['aws']['AwsSQSThawUrl'],
+        MessageBody=json.dumps({'Message': json.dumps(notification)})
+    )
+    tracker.set_state(record['retrieval_id'], retrievals.REQUEUED)
+    return 'requeued'
+
+"""Clear a dead retrieval from its jobs and ask for the restore again
+"""
+def forget(record, state):
+    tracker.set_state(record['retrieval_id'], state)
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    for job_id in record['job_ids']:
+        try:
+            table.update_item(Key={'job_id': job_id},
+                UpdateExpression='REMOVE retrieval_id, retrieval_time, retrieval_tier',
+                ConditionExpression='retrieval_id = :r',
+                ExpressionAttributeValues={':r': record['retrieval_id']}
+            )
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    sqs.send_message(
+        QueueUrl=config['aws']['AwsSQSRestoreUrl'],
+        MessageBody=json.dumps({'user_id': record['user_id']})
+    )
+
+def reconcile():
+    batch_size = config.getint('reconcile', 'BatchSize')
+    while True:
+        now = time.time()
+        records = list(tracker.in_state(retrievals.IN_PROGRESS,
+            before=now - config.getint('reconcile', 'GraceSeconds')))
+        records += [record for record in tracker.in_state(retrievals.REQUEUED, before=now)
+            if int(record.get('state_time', 0)) < now - config.getint('reconcile', 'RequeueSeconds')]
+        # A thaw that died holding its lease never sends the retrieval on
+        records += [record for record in tracker.in_state(retrievals.THAWING, before=now)
+            if int(record.get('lease_until', 0)) < now]
+
+        outcomes = {}
+        with ThreadPoolExecutor(max_workers=batch_size) as executor:
+            for i in range(0, len(records), batch_size):
+                for record, outcome in zip(records[i:i + batch_size],
+                    executor.map(safe_reconcile, records[i:i + batch_size])):
+                    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        if records:
+            print('Reconciled {} retrievals: {}'.format(len(records), outcomes))
+        for outcome, count in outcomes.items():
+            helpers.put_metric('RetrievalsReconciled', count, dimensions={'Outcome': outcome})
+        time.sleep(config.getint('reconcile', 'IntervalSeconds'))
+
+def safe_reconcile(record):
+    try:
+        return reconcile_record(record)
+    except exceptions.ClientError as e:
+        print({
+            'code': 500,
+            'status': 'error',
+            'message': 'Retrieval {} could not be reconciled: {}'.format(record['retrieval_id'], str(e))
+        })
+        return 'error'
+
+reconcile()
+### EOF
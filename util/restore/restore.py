@@ -10,13 +10,20 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import sys
 import json
+import time
 import boto3
 import botocore
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.dynamodb.types import TypeDeserializer
 from botocore import exceptions
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import cold_storage
+import retrieval_plan
+import retrievals
+from consumer import QueueConsumer
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -24,102 +31,153 @@ config = SafeConfigParser(os.environ)
 config.read('restore_config.ini')
 
 db = boto3.client('dynamodb', region_name=config['aws']['AwsRegionName'])
-sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
 sns = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
-glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
-
-def restore():
-    while True:
-        try:
-            response = sqs.receive_message(
-            QueueUrl=config['aws']['AwsSQSRestoreUrl'],
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=10
-            )
-
-            message = response['Messages'][0]
-            receipt_handle = message['ReceiptHandle']
-            data = json.loads(message['Body'])
-
-        except KeyError:
-            # Empty queue
-            continue
-
-        # Getting information from body of message
-        user_id = data['user_id']
-        profile = helpers.get_user_profile(id=user_id)
-
-        # Double checking that the restoration process is initiated by a premium user
-        if profile['role'] == 'premium_user':
+backends = cold_storage.create_backends(config)
+tracker = retrievals.RetrievalTracker(config)
+deserializer = TypeDeserializer()
+
+# Shared by every worker so the whole process stays under Glacier's limits
+limiter = helpers.RateLimiter(config.getfloat('restore', 'RetrievalsPerSecond'),
+    burst=config.getint('restore', 'RetrievalBurst'))
+
+"""All of a user's archived jobs, by backend, skipping any job with a
+retrieval started less than InFlightSeconds ago
+"""
+def find_archived(user_id):
+    in_flight_since = time.time() - config.getint('restore', 'InFlightSeconds')
+    items = {}
+
+    # Grabbing annotations that are archived from Dynamo table, every page
+    # Source: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.FilterExpression.html
+    paginator = db.get_paginator('query')
+    for page in paginator.paginate(
+        TableName=config['aws']['AwsDynamoTable'],
+        IndexName='user_id_index',
+        Select='SPECIFIC_ATTRIBUTES',
+        ProjectionExpression='job_id, archive_id, archive_offset, archive_backend, s3_key_input_file, retrieval_time, complete_time',
+        KeyConditionExpression='user_id = :u',
+        ExpressionAttributeValues={
+            ':u': {'S': user_id}},
+        FilterExpression='attribute_not_exists(s3_key_result_file) and attribute_exists(archive_id)'
+    ):
+        for item in page['Items']:
+            item = {name: deserializer.deserialize(value) for name, value in item.items()}
+            if item.get('retrieval_time', 0) > in_flight_since:
+                continue
+            # Items archived before backends were recorded are in Glacier
+            items.setdefault(item.get('archive_backend', 'glacier'), []).append(item)
+    return items
+
+"""Start one retrieval and record it on every job it restores
+"""
+def start_retrieval(user_id, backend, retrieval):
+    limiter.acquire()
+    retrieval_id = backend.start_retrieval(retrieval)
+    tracker.record(retrieval_id, backend.name, user_id, retrieval)
+
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    for job_id in retrieval['job_ids']:
+        table.update_item(Key={'job_id': job_id},
+            UpdateExpression="SET retrieval_id = :r, retrieval_time = :t, retrieval_tier = :tier",
+            ExpressionAttributeValues={
+                ':r': retrieval_id,
+                ':t': int(time.time()),
+                ':tier': retrieval['tier']
+            }
+        )
+
+"""Start every retrieval needed to restore a user's archived results
+Returns False if any retrieval could not be started; the jobs it covers
+are picked up again when the message is redelivered.
+"""
+def restore_user(user_id):
+    planned = []
+    for name, items in find_archived(user_id).items():
+        backend = backends[name]
+        touched = {item['job_id']: int(item.get('complete_time', 0)) for item in items}
+        for retrieval in backend.plan_restore(user_id, items):
+            retrieval['touched'] = max(touched[job_id] for job_id in retrieval['job_ids'])
+            planned.append((backend, retrieval))
+
+    # Choose a tier for each retrieval within the restore budget
+    plan = retrieval_plan.plan_tiers([retrieval for _, retrieval in planned], config)
+    print('Restore plan for {}: {}'.format(user_id, plan))
+    helpers.put_metric('RestoreEstimatedSeconds', plan['eta_seconds'], unit='Seconds')
+    helpers.put_metric('RestoreEstimatedCost', plan['cost'], unit='None')
+
+    succeeded = True
+    with ThreadPoolExecutor(max_workers=config.getint('restore', 'MaxWorkers')) as executor:
+        futures = [executor.submit(start_retrieval, user_id, backend, retrieval)
+            for backend, retrieval in planned]
+        for future in as_completed(futures):
             try:
-                # Grabbing annotations that are archived from Dynamo table
-                # Source: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.FilterExpression.html
-                response = db.query(
-                    TableName=config['aws']['AwsDynamoTable'],
-                    IndexName='user_id_index', 
-                    Select='SPECIFIC_ATTRIBUTES', 
-                    ProjectionExpression='archive_id, s3_key_input_file', 
-                    KeyConditionExpression='user_id = :u', 
-                    ExpressionAttributeValues={
-                        ':u': {'S': user_id}}, 
-                    FilterExpression='attribute_not_exists(s3_key_result_file) and attribute_exists(archive_id)' 
-                )
-
-                glacier_ids = response['Items']
-                for id in glacier_ids:
-                    i = id['archive_id']['S']
-                    file = id['s3_key_input_file']['S'].split('.')[0]
-
-                    try: 
-                        # Expedited Glacier job
-                        # Send thaw notification
-                        # Source: https://docs.aws.amazon.com/cli/latest/reference/glacier/initiate-job.html
-                        response = glacier.initiate_job(
-                            vaultName=config['aws']['AwsGlacierVault'], 
-                            jobParameters={'Type': 'archive-retrieval',
-                                           'ArchiveId': i,
-                                           'Description': '{}{}/{}.annot.vcf'.format(config['aws']['AwsPrefix'], user_id, file),
-                                           'SNSTopic': config['aws']['AwsSNSThawARN'], 
-                                           'Tier': 'Expedited'
-                                           }
-                        )
-
-                    # Source: https://botocore.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/exceptions/InsufficientCapacityException.html
-                    except glacier.exceptions.InsufficientCapacityException:
-                        # Standard Glacier job if there's limited capacity
-                        # Send thaw notification
-                        response = glacier.initiate_job(
-                            vaultName=config['aws']['AwsGlacierVault'], 
-                            jobParameters={'Type': 'archive-retrieval',
-                                           'ArchiveId': i, 
-                                           'Description': '{}{}/{}.annot.vcf'.format(config['aws']['AwsPrefix'], user_id, file),
-                                           'SNSTopic': config['aws']['AwsSNSThawARN'], 
-                                           'Tier': 'Standard'
-                                           }
-                        )
+                future.result()
             except exceptions.ClientError as e:
                 print({
-                    'code': 404,
-                    'status': 'error',
-                    'message': 'Dynamo table query failed: {}'.format(str(e))
-                })
-                continue
-        else:
-            pass
-
-        try:
-            sqs.delete_message(
-                QueueUrl=config['aws']['AwsSQSRestoreUrl'],
-                ReceiptHandle=receipt_handle
-                )
-        
-        except exceptions.ClientError as e:
-            print({
                     'code': 500,
                     'status': 'error',
-                    'message': 'SQS delete message failed: {}'.format(str(e))
-            })
-            continue
+                    'message': 'Glacier retrieval could not be started: {}'.format(str(e))
+                })
+                succeeded = False
+
+    print('Started {} retrievals for {}'.format(len(planned), user_id))
+    return succeeded
+
+"""Restore one result the user is waiting for, ahead of any bulk restore
+Only the job's own bytes are retrieved, always in the Expedited tier
+(Standard if Glacier has no Expedited capacity). A job that already has
+a retrieval in flight, of any tier, is left alone: start_retrieval
+records every retrieval (bundle or ranged) on each job it covers, so
+the job item shows whether a bulk restore already includes it.
+"""
+def restore_job(user_id, job_id):
+    item = dynamo.Table(config['aws']['AwsDynamoTable']).get_item(
+        Key={'job_id': job_id},
+        ProjectionExpression='job_id, user_id, archive_id, archive_offset, archive_backend, '
+            's3_key_input_file, s3_key_result_file, retrieval_time, retrieval_tier'
+    ).get('Item')
+    if item is None or item['user_id'] != user_id or 'archive_id' not in item \
+        or 's3_key_result_file' in item:
+        # Not this user's, or not archived (any more)
+        return True
+
+    in_flight_since = time.time() - config.getint('restore', 'InFlightSeconds')
+    if int(item.get('retrieval_time', 0)) > in_flight_since:
+        print('Retrieval of {} already in flight ({})'.format(job_id, item.get('retrieval_tier', 'Standard')))
+        return True
+
+    backend = backends[item.get('archive_backend', 'glacier')]
+    for retrieval in backend.plan_restore(user_id, [item]):
+        retrieval['tier'] = 'Expedited'
+        start_retrieval(user_id, backend, retrieval)
+    print('Started priority restore of {} for {}'.format(job_id, user_id))
+    return True
+
+"""Restore the archived results of the user named in one message: a
+single job (requested from its detail page) or everything (on subscribe)
+"""
+def restore(message):
+    # Getting information from body of message
+    data = json.loads(message['Body'])
+    user_id = data['user_id']
+    profile = helpers.get_user_profile(id=user_id)
+
+    # Double checking that the restoration process is initiated by a premium user
+    if profile['role'] != 'premium_user':
+        return True
+
+    try:
+        if data.get('job_id'):
+            return restore_job(user_id, data['job_id'])
+        return restore_user(user_id)
+    except exceptions.ClientError as e:
+        print({
+            'code': 404,
+            'status': 'error',
+            'message': 'Dynamo table query failed: {}'.format(str(e))
+        })
+        return False
 
-restore()
+QueueConsumer(config, config['aws']['AwsSQSRestoreUrl'], restore, 'restore').run()
 ### EOF
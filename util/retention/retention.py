@@ -0,0 +1,117 @@
+# retention.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Hands results to the archiver once their retention period has passed
+# run.py stamps each job whose owner's role has a retention period with
+# retention_due (and a retention_shard); only those jobs appear in the
+# sparse retention_index GSI, so a sweep reads just the jobs that are due.
+# Handing a job off removes its retention_shard, which takes it out of the
+# index; retention_due stays on the job, as the web server uses it for the
+# end of the free download period.
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import boto3
+
+from boto3.dynamodb.conditions import Key
+from botocore import exceptions
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+
+# Get configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read('retention_config.ini')
+
+dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+
+"""Due jobs in one shard, a page at a time
+"""
+def due_jobs(table, shard, now):
+    kwargs = {
+        'IndexName': 'retention_index',
+        'KeyConditionExpression': Key('retention_shard').eq(str(shard)) & Key('retention_due').lte(int(now)),
+        'Limit': config.getint('retention', 'BatchSize')
+    }
+    while True:
+        response = table.query(**kwargs)
+        if response['Items']:
+            yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""Send a page of due jobs to the archive queue, ten per request, and
+take the ones that were sent out of the retention index
+"""
+def hand_off(table, items):
+    sent = 0
+    for i in range(0, len(items), 10):
+        chunk = items[i:i + 10]
+        # Jobs with no results file left only need their index entry cleared
+        batch = [item for item in chunk if 's3_key_result_file' in item]
+        failed = set()
+        if batch:
+            response = sqs.send_message_batch(
+                QueueUrl=config['aws']['AwsSQSArchiveUrl'],
+                Entries=[{
+                    'Id': str(n),
+                    'MessageBody': json.dumps({
+                        'job_id': item['job_id'],
+                        'user_id': item['user_id'],
+                        's3_key_result_file': item['s3_key_result_file']
+                    })
+                } for n, item in enumerate(batch)]
+            )
+            failed = set(batch[int(entry['Id'])]['job_id'] for entry in response.get('Failed', []))
+            sent += len(batch) - len(failed)
+
+        for item in chunk:
+            if item['job_id'] in failed:
+                # Left in the index for the next sweep
+                continue
+            try:
+                table.update_item(Key={'job_id': item['job_id']},
+                    UpdateExpression='REMOVE retention_shard',
+                    ConditionExpression='retention_due = :due',
+                    ExpressionAttributeValues={':due': item['retention_due']}
+                )
+            except exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+    return sent
+
+def retention():
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    while True:
+        now = time.time()
+        expired = 0
+        for shard in range(config.getint('retention', 'Shards')):
+            try:
+                for items in due_jobs(table, shard, now):
+                    expired += hand_off(table, items)
+            except exceptions.ClientError as e:
+                print({
+                    'code': 500,
+                    'status': 'error',
+                    'message': 'Retention sweep of shard {} failed: {}'.format(shard, str(e))
+                })
+
+        if expired:
+            print('Handed {} expired results to the archiver'.format(expired))
+            helpers.put_metric('RetentionExpired', expired)
+        time.sleep(max(0, now + config.getint('retention', 'SweepSeconds') - time.time()))
+
+retention()
+### EOF
@@ -0,0 +1,84 @@
+# retrieval_plan.py
+#
+# Retrieval tier planner for restores
+# Chooses a Glacier retrieval tier for each planned retrieval: Expedited
+# for the results the user touched most recently, Standard and then Bulk
+# for the long tail, all within a per-restore cost budget.
+#
+##
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Cheapest and slowest last
+TIERS = ('Expedited', 'Standard', 'Bulk')
+
+"""Per-tier pricing and latency, from the [tiers] config section
+"""
+def load_tiers(config):
+    return {tier: {
+        'per_gb': config.getfloat('tiers', '{}PerGB'.format(tier)),
+        'per_request': config.getfloat('tiers', '{}PerRequest'.format(tier)),
+        'hours': config.getfloat('tiers', '{}Hours'.format(tier))
+    } for tier in TIERS}
+
+def retrieval_bytes(retrieval, default_size):
+    return retrieval['size'] if retrieval.get('size') is not None else default_size
+
+def retrieval_cost(tiers, retrieval, default_size):
+    pricing = tiers[retrieval['tier']]
+    return pricing['per_request'] + pricing['per_gb'] * retrieval_bytes(retrieval, default_size) / GB
+
+"""Assign a tier to every retrieval (in place) and summarise the plan
+Retrievals are ranked by `touched`, the latest time the user worked with
+any result they cover. The most recent ones are Expedited (up to
+ExpeditedCount retrievals and ExpeditedMB), the next StandardMB are
+Standard and the rest Bulk. If the plan costs more than BudgetUSD, the
+oldest retrievals are moved to slower tiers until it fits, or until
+everything is Bulk.
+"""
+def plan_tiers(retrievals, config):
+    tiers = load_tiers(config)
+    default_size = config.getint('planner', 'DefaultSizeMB') * MB
+    expedited_count = config.getint('planner', 'ExpeditedCount')
+    expedited_bytes = config.getint('planner', 'ExpeditedMB') * MB
+    standard_bytes = config.getint('planner', 'StandardMB') * MB
+    budget = config.getfloat('planner', 'BudgetUSD')
+
+    ranked = sorted(retrievals, key=lambda retrieval: retrieval.get('touched', 0), reverse=True)
+    expedited = standard = 0
+    for retrieval in ranked:
+        size = retrieval_bytes(retrieval, default_size)
+        if expedited < expedited_count and size <= expedited_bytes:
+            retrieval['tier'] = 'Expedited'
+            expedited += 1
+            expedited_bytes -= size
+        elif size <= standard_bytes - standard:
+            retrieval['tier'] = 'Standard'
+            standard += size
+        else:
+            retrieval['tier'] = 'Bulk'
+
+    # Downgrade the oldest first until the plan fits the budget
+    cost = sum(retrieval_cost(tiers, retrieval, default_size) for retrieval in ranked)
+    for tier in TIERS[:-1]:
+        for retrieval in reversed(ranked):
+            if cost <= budget:
+                break
+            if retrieval['tier'] != tier:
+                continue
+            cost -= retrieval_cost(tiers, retrieval, default_size)
+            retrieval['tier'] = TIERS[TIERS.index(tier) + 1]
+            cost += retrieval_cost(tiers, retrieval, default_size)
+
+    used = set(retrieval['tier'] for retrieval in ranked)
+    return {
+        'retrievals': {tier: sum(1 for r in ranked if r['tier'] == tier) for tier in TIERS},
+        'bytes': sum(retrieval_bytes(retrieval, default_size) for retrieval in ranked),
+        'cost': round(cost, 4),
+        # Retrievals run in parallel, so everything is back once the
+        # slowest tier in the plan completes
+        'eta_seconds': int(max([tiers[tier]['hours'] for tier in used] or [0]) * 3600)
+    }
+
+### EOF
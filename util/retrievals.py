@@ -0,0 +1,129 @@
+# retrievals.py
+#
+# Durable record of every cold storage retrieval the restore utility starts
+# One item per retrieval (keyed by the Glacier job ID, or the S3 key for
+# object restores) holds the archive, tier, jobs, target keys and state.
+# thaw claims an item before copying the output and checkpoints the
+# results it has copied and verified, so a failed thaw resumes instead of
+# starting over; the reconciler uses the IN_PROGRESS items to find
+# retrievals whose notification never arrived, and THAWING items with an
+# expired lease to find thaws that stopped partway.
+#
+# States: IN_PROGRESS -> (REQUEUED) -> THAWING -> THAWED
+#                     -> FAILED | EXPIRED
+##
+
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore import exceptions
+
+IN_PROGRESS = 'IN_PROGRESS'
+REQUEUED = 'REQUEUED'
+THAWING = 'THAWING'
+THAWED = 'THAWED'
+FAILED = 'FAILED'
+EXPIRED = 'EXPIRED'
+
+class RetrievalTracker(object):
+    def __init__(self, config):
+        self.table = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName']).Table(
+            config['aws']['AwsDynamoRetrievalsTable'])
+
+    """Record a retrieval that has just been started
+    """
+    def record(self, retrieval_id, backend, user_id, retrieval):
+        item = {
+            'retrieval_id': retrieval_id,
+            'backend': backend,
+            'user_id': user_id,
+            'archive_id': retrieval['archive_id'],
+            'tier': retrieval.get('tier', 'Standard'),
+            'job_ids': retrieval['job_ids'],
+            'targets': retrieval['targets'],
+            'state': IN_PROGRESS,
+            'initiate_time': int(time.time())
+        }
+        if retrieval.get('byte_range') is not None:
+            item['byte_range'] = '{}-{}'.format(*retrieval['byte_range'])
+        self.table.put_item(Item=item)
+
+    def get(self, retrieval_id):
+        return self.table.get_item(Key={'retrieval_id': retrieval_id}).get('Item')
+
+    """Take the retrieval for thawing for lease_seconds
+    Returns (status, item): 'claimed' with the item, 'untracked' for
+    retrievals started before tracking, 'thawed' if it is already done,
+    or 'busy' if another thaw holds the lease.
+    """
+    def claim(self, retrieval_id, lease_seconds):
+        item = self.get(retrieval_id)
+        if item is None:
+            return 'untracked', None
+        if item['state'] == THAWED:
+            return 'thawed', item
+
+        now = int(time.time())
+        try:
+            response = self.table.update_item(
+                Key={'retrieval_id': retrieval_id},
+                UpdateExpression='SET #state = :thawing, lease_until = :lease',
+                ConditionExpression='#state <> :thawed AND (attribute_not_exists(lease_until) OR lease_until < :now)',
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={
+                    ':thawing': THAWING,
+                    ':thawed': THAWED,
+                    ':lease': now + lease_seconds,
+                    ':now': now
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return 'busy', item
+        return 'claimed', response['Attributes']
+
+    """Note that jobs' results have been copied back to S3 and verified
+    """
+    def checkpoint(self, retrieval_id, job_ids):
+        self.table.update_item(
+            Key={'retrieval_id': retrieval_id},
+            UpdateExpression='ADD copied :j',
+            ExpressionAttributeValues={':j': set(job_ids)}
+        )
+
+    """Give up the lease after a failed thaw so it can be retried at once
+    """
+    def release(self, retrieval_id):
+        self.table.update_item(
+            Key={'retrieval_id': retrieval_id},
+            UpdateExpression='REMOVE lease_until'
+        )
+
+    def set_state(self, retrieval_id, state):
+        self.table.update_item(
+            Key={'retrieval_id': retrieval_id},
+            UpdateExpression='SET #state = :s, state_time = :t REMOVE lease_until',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={':s': state, ':t': int(time.time())}
+        )
+
+    """Retrievals in a state that were started before `before`, oldest first
+    Uses the state_index GSI (state, initiate_time)
+    """
+    def in_state(self, state, before):
+        kwargs = {
+            'IndexName': 'state_index',
+            'KeyConditionExpression': Key('state').eq(state) & Key('initiate_time').lt(int(before))
+        }
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+### EOF
@@ -0,0 +1,104 @@
+# stats.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Corrects drift in the per-user job aggregates
+# The aggregates are adjusted incrementally and best-effort (see
+# job_stats.py), so a lost or repeated adjustment leaves them off. Every
+# IntervalSeconds the annotations table is scanned, each user's counters
+# are recounted from their jobs and the ones that differ are replaced.
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore import exceptions
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+import job_stats
+
+# Get configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read('stats_config.ini')
+
+dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+stats = job_stats.JobStats(config)
+
+"""Counters for every user with jobs in one segment of the table
+"""
+def count_segment(segment, segments):
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    counts = {}
+    kwargs = {
+        'Segment': segment,
+        'TotalSegments': segments,
+        'ProjectionExpression': 'user_id, job_status, storage_status, s3_key_result_file, archive_id, result_size'
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response['Items']:
+            user_counts = counts.setdefault(item['user_id'], {})
+            for name, value in job_stats.count_job(item).items():
+                user_counts[name] = user_counts.get(name, 0) + value
+        if 'LastEvaluatedKey' not in response:
+            return counts
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""Recount every user and correct the ones whose counters drifted
+"""
+def recount():
+    started = time.time()
+    segments = config.getint('stats', 'Segments')
+    counts = {}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for segment_counts in executor.map(count_segment, range(segments), [segments] * segments):
+            for user_id, user_counts in segment_counts.items():
+                total = counts.setdefault(user_id, {})
+                for name, value in user_counts.items():
+                    total[name] = total.get(name, 0) + value
+
+    corrected = skipped = 0
+    current = {item['user_id']: item for item in stats.scan()}
+    for user_id in set(counts) | set(current):
+        expected = {name: value for name, value in counts.get(user_id, {}).items() if value}
+        item = current.get(user_id, {})
+        actual = {name: int(value) for name, value in item.items()
+            if (name in job_stats.COUNTERS or name.startswith('jobs_')) and value}
+        if expected == actual:
+            continue
+        if stats.replace(user_id, expected, started):
+            print('Corrected job stats for {}: {} -> {}'.format(user_id, actual, expected))
+            corrected += 1
+        else:
+            # Adjusted since the scan began; recounted next time
+            skipped += 1
+
+    print('Recounted job stats for {} users in {:.1f}s: {} corrected, {} skipped'.format(
+        len(counts), time.time() - started, corrected, skipped))
+    helpers.put_metric('JobStatsCorrected', corrected)
+
+def run():
+    while True:
+        started = time.time()
+        try:
+            recount()
+        except exceptions.ClientError as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Job stats could not be recounted: {}'.format(str(e))
+            })
+        time.sleep(max(0, started + config.getint('stats', 'IntervalSeconds') - time.time()))
+
+run()
+### EOF
@@ -0,0 +1,178 @@
+# submit.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Creates annotation jobs directly from S3 upload notifications, so a job
+# no longer depends on the browser following success_action_redirect
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import time
+import json
+import boto3
+
+from urllib.parse import unquote_plus
+from botocore import exceptions
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+import job_stats
+
+# Get configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read('submit_config.ini')
+
+dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+sns = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
+stats = job_stats.JobStats(config)
+
+# Same key layout that views.annotate hands out: <prefix>/<user>/<uuid>~<file>.vcf
+KEY_PATTERN = re.compile(r'^(.+/)([^/]+)/([a-z0-9-]+)~(.+\.vcf)$')
+
+"""Pull the S3 event records out of a queue message
+The uploads queue may be subscribed to S3 directly or through SNS
+"""
+def get_records(message):
+    body = json.loads(message['Body'])
+    if 'Message' in body:
+        body = json.loads(body['Message'])
+    # S3 sends an s3:TestEvent with no records when notifications are configured
+    return body.get('Records', [])
+
+"""Create the job item and publish the job request for one uploaded object
+"""
+def submit_job(bucket, key):
+    match = KEY_PATTERN.match(key)
+    if not match or match.group(1) != config['aws']['AwsS3Prefix']:
+        print({
+            'code': 400,
+            'status': 'error',
+            'message': 'Ignoring upload with unexpected key format: {}'.format(key)
+        })
+        return
+
+    user = match.group(2)
+    id = match.group(3)
+    filename = match.group(4)
+
+    data = {"job_id": id,
+            "user_id": user,
+            "input_file_name": filename,
+            "s3_inputs_bucket": bucket,
+            "s3_key_input_file": '{}~{}'.format(id, filename),
+            "submit_time": int(time.time()),
+            "job_status": "PENDING"
+            }
+
+    # Persist job to database; S3 notifications are delivered at least
+    # once, so only the first one for a job ID creates the job
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    try:
+        table.put_item(Item=data, ConditionExpression='attribute_not_exists(job_id)')
+        stats.submitted(user)
+    except exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        item = table.get_item(Key={'job_id': id}, ConsistentRead=True).get('Item', {})
+        if item.get('job_status') != 'PENDING' or item.get('published'):
+            helpers.put_metric(name='DuplicateJobsPrevented', dimensions={'Stage': 'submit'})
+            print({
+                'code': 409,
+                'status': 'error',
+                'message': 'Job {} was already submitted.'.format(id)
+            })
+            return
+        # The job was created but its request was never published, e.g. the
+        # publish failed before an earlier delivery of this notification
+        # was retried
+
+    # Send message to request queue
+    sns.publish(
+        TopicArn=config['aws']['AwsSNSJobRequestARN'],
+        Message=json.dumps(data),
+        MessageGroupId='jobRequestsGroup',
+        MessageDeduplicationId=id
+    )
+    # Later deliveries of the notification only publish unmarked jobs
+    table.update_item(Key={'job_id': id},
+        UpdateExpression='SET published = :t',
+        ExpressionAttributeValues={':t': True})
+
+    print({
+        "code": 201,
+        "data": {
+            "job_id": id,
+            "input_file": filename,
+        }
+    })
+
+def submit():
+    while True:
+        try:
+            response = sqs.receive_message(
+                QueueUrl=config['aws']['AwsSQSUploadsUrl'],
+                MaxNumberOfMessages=1,
+                WaitTimeSeconds=10
+            )
+        except Exception as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'SQS Error: Upload messages could not be received: {}'.format(str(e))
+            })
+            time.sleep(10)
+            continue
+
+        try:
+            message = response['Messages'][0]
+            receipt_handle = message['ReceiptHandle']
+            records = get_records(message)
+
+        except KeyError:
+            # Empty queue
+            continue
+
+        try:
+            for record in records:
+                if not record.get('eventName', '').startswith('ObjectCreated:'):
+                    continue
+                # Object keys arrive URL-encoded in S3 event notifications
+                # Source: https://docs.aws.amazon.com/AmazonS3/latest/userguide/notification-content-structure.html
+                submit_job(record['s3']['bucket']['name'],
+                    unquote_plus(record['s3']['object']['key']))
+
+        except Exception as e:
+            # Leave the message on the queue so the submission is retried;
+            # any failure (AWS, connection, unexpected data) must not stop
+            # the daemon
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'Job could not be submitted: {}'.format(str(e))
+            })
+            continue
+
+        try:
+            sqs.delete_message(
+                QueueUrl=config['aws']['AwsSQSUploadsUrl'],
+                ReceiptHandle=receipt_handle
+            )
+
+        except exceptions.ClientError as e:
+            print({
+                'code': 500,
+                'status': 'error',
+                'message': 'SQS Error: Upload message could not be deleted: {}'.format(str(e))
+            })
+
+submit()
+### EOF
@@ -17,121 +17,97 @@ from botocore import exceptions
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import cold_storage
+import job_stats
+import retrievals
+from consumer import QueueConsumer
 
 # Get configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read('thaw_config.ini')
 
-db = boto3.client('dynamodb', region_name=config['aws']['AwsRegionName'])
 dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
-sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
-glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
-
-def thaw():
-    while True:
-        response = sqs.receive_message(
-            QueueUrl=config['aws']['AwsSQSThawUrl'],
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=10
-        )
-        try:
-            message = response['Messages'][0]
-            receipt_handle = message['ReceiptHandle']
-            body = json.loads(message['Body'])
-            data = json.loads(body['Message'])
-
-        except KeyError:
-            # Empty queue
-            continue
-        
-        # Getting information from body of message
-        retrieval_id = data['JobId']
-        archive_id = data['ArchiveId']
-        filename = data['JobDescription']
-        s_index = filename.rfind("/") + 1
-        e_index = filename.find("~")
-        job_id = filename[s_index:e_index]
-
-        # Getting body of file
-        # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
-        job = glacier.get_job_output(
-            accountId='-',
-            vaultName=config['aws']['AwsGlacierVault'],
-            jobId=retrieval_id,
-        )
-        message_body = job['body'].read()
-
-        try:
-            # Uploading to S3 results bucket
-            # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/put_object.html
-            s3.put_object(
-                Body=message_body,
-                Bucket=config['aws']['AwsS3ResultsBucket'],
-                Key=filename
-            )
-
+backends = cold_storage.create_backends(config)
+tracker = retrievals.RetrievalTracker(config)
+stats = job_stats.JobStats(config)
+
+"""Point a job back at its restored results file
+"""
+def mark_restored(job_id, filename):
+    # Updating status in Dynamo table
+    table = dynamo.Table(config['aws']['AwsDynamoTable'])
+    old = table.update_item(Key={'job_id': str(job_id)},
+        UpdateExpression="SET storage_status = :ss, s3_key_result_file = :filename REMOVE archive_id, archive_offset, archive_size, archive_backend, retrieval_id, retrieval_time, retrieval_tier, restore_requested_time",
+        ExpressionAttributeValues={
+            ':ss': 'RESTORED',
+            ':filename': filename
+        },
+        ReturnValues='ALL_OLD'
+    ).get('Attributes', {})
+    # A job thawed twice (e.g. by two retrievals) is only counted once
+    if 'archive_id' in old:
+        stats.restored(old['user_id'], int(old.get('result_size', 0)))
+
+"""Thaw the retrieval announced by one message
+The message is only deleted once the results are safely back in S3.
+"""
+def thaw_message(message):
+    body = json.loads(message['Body'])
+    data = json.loads(body['Message'])
+
+    # Glacier job notifications carry a JobId; S3 restore completions
+    # are S3 event records
+    if 'JobId' in data:
+        backend = backends['glacier']
+    elif 'Records' in data:
+        backend = backends['s3']
+    else:
+        # e.g. the s3:TestEvent sent when notifications are configured
+        return True
+
+    # The same retrieval can be announced twice (SNS and the
+    # reconciler); only one thaw at a time holds its record
+    retrieval_id = backend.retrieval_id(data)
+    status, record = tracker.claim(retrieval_id, config.getint('thaw', 'LeaseSeconds'))
+    if status == 'busy':
+        # Another thaw is working on it; look again when the message reappears
+        return None
+    if status == 'thawed':
+        return True
+
+    try:
+        bytes_moved = backend.thaw(data, record, tracker, mark_restored)
+    except Exception as e:
+        # ClientError, S3UploadFailedError, ChecksumMismatch, connection
+        # errors, a malformed record... any of them leaves the thaw unfinished
         # Source: https://github.com/boto/boto3/issues/3055
-        except boto3.exceptions.S3UploadFailedError as e:
-            print({
-                'code': 500,
-                'status': 'Server Error',
-                'message': 'S3 could not upload file: {}'.format(str(e)),
-            })
-            continue
-
-        try:
-            # Updating status in Dynamo table
-            table = dynamo.Table(config['aws']['AwsDynamoTable'])
-            table.update_item(Key= {'job_id': str(job_id)},
-                    UpdateExpression="SET storage_status = :ss, archive_id = :a,  s3_key_result_file = :filename",
-                    ExpressionAttributeValues={
-                        ':ss': 'RESTORED',
-                        ':a': '',
-                        ':filename': filename
-                        },
-                ReturnValues="UPDATED_NEW"
-                )
-
-        except exceptions.ClientError as e:
-            print({
-                'code': 404,
-                'status': 'error',
-                'message': 'Error updating DynamoTable, file not found: {}'.format(str(e))
-            })
-            continue
-
-        try:
-            sqs.delete_message(
-                QueueUrl=config['aws']['AwsSQSThawUrl'],
-                ReceiptHandle=receipt_handle
-                )
-
-        except exceptions.ClientError as e:
-            print({
-                'code': 500,
-                'status': 'error',
-                'message': 'SQS Error: Thaw message could not be deleted: {}'.format(str(e))
-            })
-        
-        try:
-            # Delete file from Glacier vault
-            # Source: https://docs.aws.amazon.com/cli/latest/reference/glacier/delete-archive.html
-            glacier.delete_archive(
-                accountId='-',
-                vaultName=config['aws']['AwsGlacierVault'],
-                archiveId=archive_id
-            )
-        
-        except exceptions.ClientError as e:
-            print({
-                'code': 500,
-                'status': 'error',
-                'message': 'Glacier Error: {}'.format(str(e))
-            })
-
-        print("File was successfully thawed")
-
-thaw()
+        print({
+            'code': 500,
+            'status': 'Server Error',
+            'message': 'Results could not be thawed: {}'.format(str(e)),
+        })
+        # Give the lease back so the retry does not wait for it to expire
+        if record is not None:
+            try:
+                tracker.release(retrieval_id)
+            except (exceptions.ClientError, exceptions.BotoCoreError) as e:
+                print({
+                    'code': 500,
+                    'status': 'Server Error',
+                    'message': 'Lease on {} could not be released: {}'.format(retrieval_id, str(e)),
+                })
+        return False
+
+    if record is not None:
+        tracker.set_state(retrieval_id, retrievals.THAWED)
+    helpers.put_metric('ThawBytesMoved', bytes_moved, unit='Bytes',
+        dimensions={'Backend': backend.name})
+    print("File was successfully thawed with {}: {} bytes moved".format(backend.name, bytes_moved))
+    return True
+
+# Each thaw holds one PartSizeMB part in memory at a time, so running
+# MemoryBudgetMB / PartSizeMB of them keeps the whole process in budget
+QueueConsumer(config, config['aws']['AwsSQSThawUrl'], thaw_message, 'thaw',
+    workers=max(1, config.getint('thaw', 'MemoryBudgetMB') // config.getint('thaw', 'PartSizeMB'))).run()
 ### EOF
@@ -0,0 +1,66 @@
+# app_setup.py
+#
+# GAS additions to the runtime environment that gas.py configures
+# Called once from views.py, which gas.py imports after creating the app
+# and the database handle, so gas.py and auth.py stay as provided.
+#
+##
+
+from flask import request, session
+
+from helpers import invalidate_cached_profile, stamp_cached_profile
+from log_handlers import init_logging
+from sessions import create_session_interface, regenerate_session
+from assets import init_assets
+from profiler import init_profiler
+
+"""Keep the session in step with logins and profile changes made by auth.py
+authcallback and the profile page copy the profile into the session
+themselves; those copies are stamped as cached profiles, edits on the
+profile page invalidate it, and a completed login moves the session to a
+new ID so an ID planted or seen before login is worthless afterwards.
+The session is saved after these hooks run.
+"""
+def init_auth_hooks(app):
+  @app.after_request
+  def after_auth_request(response):
+    if request.endpoint == 'authcallback' and 'code' in request.args and \
+      session.get('is_authenticated'):
+      regenerate_session(session)
+      if session.get('role'):
+        stamp_cached_profile()
+    elif request.endpoint == 'profile':
+      if request.method == 'POST':
+        invalidate_cached_profile()
+      elif session.get('role'):
+        stamp_cached_profile()
+    return response
+
+"""Install the GAS logging, sessions (with the login hooks), assets and
+profiler on the app, and start the secrets cache refresher
+"""
+def init_app(app):
+  # JSON logs written by a listener thread (see log_handlers.py)
+  init_logging(app)
+
+  # Keep session data server-side when configured (see sessions.py)
+  app.session_interface = create_session_interface(app)
+  init_auth_hooks(app)
+
+  # Fingerprinted, precompressed static assets (see build_assets.py)
+  init_assets(app)
+
+  # Count and time AWS and SQL calls per request and per route
+  init_profiler(app)
+
+  app.logger.info(f"Loaded GAS secrets in {app.config['GAS_SECRETS_LOAD_SECONDS']:.3f}s")
+
+  # Keep the shared secrets cache warm for workers that boot later
+  secrets_provider = app.config['GAS_SECRETS_PROVIDER']
+  if secrets_provider.caching:
+    secrets_provider.start_refresher(logger=app.logger)
+  else:
+    app.logger.warning("Secrets cache disabled (set GAS_SECRETS_CACHE_KEY " +
+      "and install cryptography); each worker loads secrets from ASM")
+
+### EOF
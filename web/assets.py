@@ -0,0 +1,63 @@
+# assets.py
+#
+# Serve the fingerprinted static assets built by build_assets.py
+# Hashed file names never change content, so they are served with
+# immutable, year-long cache headers and a precompressed variant
+# (brotli or gzip) matching the client's Accept-Encoding.
+#
+##
+
+import os
+import json
+import mimetypes
+
+from flask import abort, request, send_from_directory, url_for
+
+from build_assets import DIST_DIR
+
+"""Register the asset_url template helper and the /assets route
+"""
+def init_assets(app):
+  manifest_path = os.path.join(DIST_DIR, 'manifest.json')
+  if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+  else:
+    app.logger.warning('No asset manifest; run build_assets.py. Serving unversioned static files.')
+    manifest = {}
+  served = set(manifest.values())
+
+  """URL of the fingerprinted copy of a static file, if there is one
+  """
+  @app.context_processor
+  def asset_url_processor():
+    def asset_url(filename):
+      if filename in manifest:
+        return url_for('asset', filename=manifest[filename])
+      return url_for('static', filename=filename)
+    return dict(asset_url=asset_url)
+
+  @app.route('/assets/<path:filename>', methods=['GET'])
+  def asset(filename):
+    if filename not in served:
+      abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.accept_encodings
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+      if accepted[candidate] and os.path.exists(os.path.join(DIST_DIR, filename + suffix)):
+        encoding = candidate
+        filename = filename + suffix
+        break
+
+    response = send_from_directory(DIST_DIR, filename, mimetype=mimetype,
+      max_age=app.config['GAS_ASSET_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+      response.headers['Content-Encoding'] = encoding
+    return response
+
+### EOF
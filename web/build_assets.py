@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# build_assets.py
+#
+# Build step for the GAS static assets
+# Copies every file under static/ into static/dist/ with a content hash
+# in its name, rewrites url() references in CSS to the hashed names,
+# pre-compresses text assets with gzip (and brotli, if installed) and
+# writes static/dist/manifest.json for the asset_url template helper.
+#
+# Usage: python build_assets.py
+##
+
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+STATIC_DIR = os.path.join(basedir, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+# Already-compressed formats gain nothing from gzip/brotli
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.ttf', '.eot', '.json', '.txt')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")?#]+)([^'")]*)\1\s*\)''')
+
+"""Static files to fingerprint, as paths relative to static/
+CSS last, so that the files it references are already hashed
+"""
+def find_assets():
+  assets = []
+  for root, dirs, files in os.walk(STATIC_DIR):
+    if os.path.abspath(root).startswith(DIST_DIR):
+      continue
+    for name in files:
+      assets.append(os.path.relpath(os.path.join(root, name), STATIC_DIR).replace(os.sep, '/'))
+  return sorted(assets, key=lambda path: (path.endswith('.css'), path))
+
+"""Point relative url() references in a stylesheet at hashed files
+"""
+def rewrite_css(css, css_path, manifest):
+  css_dir = os.path.dirname(css_path)
+
+  def replace(match):
+    quote, target, suffix = match.groups()
+    if re.match(r'^([a-z]+:|/)', target):
+      return match.group(0)
+    resolved = os.path.normpath(os.path.join(css_dir, target)).replace(os.sep, '/')
+    if resolved not in manifest:
+      return match.group(0)
+    relative = os.path.relpath(manifest[resolved], css_dir).replace(os.sep, '/')
+    return f"url({quote}{relative}{suffix}{quote})"
+
+  return CSS_URL.sub(replace, css)
+
+def write_compressed(path, data):
+  with gzip.open(path + '.gz', 'wb', compresslevel=9) as f:
+    f.write(data)
+  if brotli:
+    with open(path + '.br', 'wb') as f:
+      f.write(brotli.compress(data, quality=11))
+
+def build():
+  if os.path.exists(DIST_DIR):
+    shutil.rmtree(DIST_DIR)
+
+  manifest = {}
+  for asset in find_assets():
+    with open(os.path.join(STATIC_DIR, asset), 'rb') as f:
+      data = f.read()
+    if asset.endswith('.css'):
+      data = rewrite_css(data.decode('utf-8'), asset, manifest).encode('utf-8')
+
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    base, ext = os.path.splitext(asset)
+    hashed = f"{base}.{digest}{ext}"
+    manifest[asset] = hashed
+
+    target = os.path.join(DIST_DIR, hashed)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+      f.write(data)
+    if ext.lower() in COMPRESSIBLE:
+      write_compressed(target, data)
+
+  with open(os.path.join(DIST_DIR, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  return manifest
+
+if __name__ == '__main__':
+  manifest = build()
+  print(f"Fingerprinted {len(manifest)} assets into {DIST_DIR}" +
+    ("" if brotli else " (brotli not installed; gzip only)"))
+
+### EOF
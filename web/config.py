@@ -10,12 +10,21 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
 import boto3
 import base64
+from configparser import ConfigParser
 from botocore.exceptions import ClientError
 
+from secrets_provider import SecretsProvider
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Results retention is configured once, in the annotator's [retention]
+# section, which also schedules the archiving of results
+ann_config = ConfigParser(interpolation=None)
+ann_config.read(os.path.join(basedir, os.pardir, 'ann', 'ann_config.ini'))
+
 class Config(object):
   GAS_LOG_LEVEL = os.environ['GAS_LOG_LEVEL'] \
     if ('GAS_LOG_LEVEL' in os.environ) else 'INFO'
@@ -24,6 +33,29 @@ class Config(object):
   GAS_LOG_FILE_NAME = os.environ['GAS_LOG_FILE_NAME'] \
     if ('GAS_LOG_FILE_NAME' in os.environ) else "gas.log"
 
+  # Fraction of requests per route (endpoint name) whose DEBUG log
+  # lines are kept; routes not listed keep all of them
+  GAS_LOG_DEBUG_SAMPLE_RATES = {
+    'annotations_list': 0.1,
+    'static': 0.01
+  }
+
+  # Where session data lives: "cookie" (signed cookie, Flask default),
+  # "memory" (in-process LRU; single node only) or "dynamodb" (shared)
+  GAS_SESSION_BACKEND = os.environ['GAS_SESSION_BACKEND'] \
+    if ('GAS_SESSION_BACKEND' in os.environ) else "cookie"
+  GAS_SESSION_MEMORY_MAX_ENTRIES = 10000
+
+  # Threads per process for running independent AWS calls concurrently
+  GAS_BACKEND_THREADS = int(os.environ['GAS_BACKEND_THREADS']) \
+    if ('GAS_BACKEND_THREADS' in os.environ) else 8
+
+  # Cache lifetime (in seconds) for fingerprinted static assets
+  GAS_ASSET_MAX_AGE = 31536000
+
+  # Number of recent requests per route kept for profiler percentiles
+  GAS_PROFILER_WINDOW = 1000
+
   WSGI_SERVER = 'werkzeug'
   CSRF_ENABLED = True
 
@@ -38,45 +70,85 @@ class Config(object):
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
   # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-
-  # Get Flask application secret
+  # All secrets are fetched in one batched call and shared between
+  # workers through an encrypted cache file (see secrets_provider.py).
+  # The cache is only used when GAS_SECRETS_CACHE_KEY holds a Fernet key
+  # and cryptography is installed; otherwise every worker goes to ASM.
+  # Values are read once per worker, so rotated secrets apply on restart.
+  GAS_SECRETS_CACHE_PATH = os.environ['GAS_SECRETS_CACHE_PATH'] \
+    if ('GAS_SECRETS_CACHE_PATH' in os.environ) else basedir + "/.secrets.cache"
+  GAS_SECRETS_CACHE_TTL = int(os.environ['GAS_SECRETS_CACHE_TTL']) \
+    if ('GAS_SECRETS_CACHE_TTL' in os.environ) else 3600
+
+  GAS_SECRETS_PROVIDER = SecretsProvider(
+    ['gas/web_server', 'rds/accounts_database', 'globus/auth_client'],
+    region_name=AWS_REGION_NAME,
+    cache_path=GAS_SECRETS_CACHE_PATH,
+    cache_key=os.environ.get('GAS_SECRETS_CACHE_KEY'),
+    ttl=GAS_SECRETS_CACHE_TTL)
+
+  secrets_load_start = time.time()
   try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
+    gas_secrets = GAS_SECRETS_PROVIDER.load()
   except ClientError as e:
-    print(f"Unable to retrieve Flask secret from ASM: {e}")
+    print(f"Unable to retrieve GAS secrets from ASM: {e}")
     raise e
+  # Reported at startup by gas.py
+  GAS_SECRETS_LOAD_SECONDS = time.time() - secrets_load_start
+
+  # Get Flask application secret
+  flask_secret = gas_secrets['gas/web_server']
   SECRET_KEY = flask_secret['flask_secret_key']
 
   # Get RDS secret and construct database URI
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve accounts database credentials from ASM: {e}")
-    raise e
+  rds_secret = gas_secrets['rds/accounts_database']
 
   SQLALCHEMY_DATABASE_TABLE = os.environ['ACCOUNTS_DATABASE_TABLE']
   SQLALCHEMY_DATABASE_URI = "postgresql://" + \
     rds_secret['username'] + ':' + rds_secret['password'] + \
     '@' + rds_secret['host'] + ':' + str(rds_secret['port']) + \
     '/' + SQLALCHEMY_DATABASE_TABLE
-  SQLALCHEMY_TRACK_MODIFICATIONS = True
+  SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+  # Read-only profile lookups go to these replicas (see replicas.py);
+  # "replica_hosts" in the RDS secret lists them as host:port
+  SQLALCHEMY_REPLICA_URIS = []
+  for replica_host in rds_secret.get('replica_hosts', []):
+    SQLALCHEMY_REPLICA_URIS.append("postgresql://" + \
+      rds_secret['username'] + ':' + rds_secret['password'] + \
+      '@' + replica_host + '/' + SQLALCHEMY_DATABASE_TABLE)
+
+  # Point both at a local Postgres to run without RDS, e.g. in tests
+  if 'ACCOUNTS_DATABASE_URI' in os.environ:
+    SQLALCHEMY_DATABASE_URI = os.environ['ACCOUNTS_DATABASE_URI']
+  if 'ACCOUNTS_DATABASE_REPLICA_URIS' in os.environ:
+    SQLALCHEMY_REPLICA_URIS = \
+      os.environ['ACCOUNTS_DATABASE_REPLICA_URIS'].split(',')
+
+  # Connection pool settings, per process, for primary and replicas
+  SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': int(os.environ['ACCOUNTS_DATABASE_POOL_SIZE']) \
+      if ('ACCOUNTS_DATABASE_POOL_SIZE' in os.environ) else 5,
+    'max_overflow': int(os.environ['ACCOUNTS_DATABASE_MAX_OVERFLOW']) \
+      if ('ACCOUNTS_DATABASE_MAX_OVERFLOW' in os.environ) else 5,
+    'pool_timeout': 10,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True
+  }
+  SQLALCHEMY_REPLICA_RETRY_SECONDS = 30
+  SQLALCHEMY_SLOW_QUERY_SECONDS = 0.2
 
   # Get the Globus Auth client ID and secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
-    raise e
+  globus_auth = gas_secrets['globus/auth_client']
 
   # Set the Globus Auth client ID and secret
   GAS_CLIENT_ID = globus_auth['gas_client_id']
   GAS_CLIENT_SECRET = globus_auth['gas_client_secret']
   GLOBUS_AUTH_LOGOUT_URI = "https://auth.globus.org/v2/web/logout"
 
+  # Refresh cached portal tokens this long (in seconds) before they expire
+  GAS_PORTAL_TOKEN_REFRESH_AHEAD = 300
+
   # Set validity of pre-signed POST requests (in seconds)
   AWS_SIGNED_REQUEST_EXPIRATION = 60
 
@@ -94,16 +166,58 @@ class Config(object):
   AWS_SNS_JOB_REQUEST_TOPIC = 'arn:aws:sns:us-east-1:659248683008:maxinexu_job_requests.fifo'
   AWS_SNS_JOB_COMPLETE_TOPIC = 'arn:aws:sns:us-east-1:659248683008:maxinexu_job_results.fifo'
   AWS_SQS_RESTORE_QUEUE = 'https://sqs.us-east-1.amazonaws.com/659248683008/maxinexu_restore'
+
+  # Create jobs from S3 upload notifications (util/submit) instead of
+  # from the success_action_redirect request
+  AWS_S3_EVENT_SUBMISSION = (os.environ['AWS_S3_EVENT_SUBMISSION'] \
+    if ('AWS_S3_EVENT_SUBMISSION' in os.environ) else "true").lower() == "true"
   
 
+  # CloudWatch namespace for GAS metrics
+  AWS_CLOUDWATCH_NAMESPACE = "maxinexu_gas"
+
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "maxinexu_annotations"
+  AWS_DYNAMODB_RATE_LIMITS_TABLE = "maxinexu_rate_limits"
+  AWS_DYNAMODB_SESSIONS_TABLE = "maxinexu_sessions"
+  AWS_DYNAMODB_JOB_STATS_TABLE = "maxinexu_job_stats"
+
+  # Set to a DynamoDB Local URL to run the shared tables without AWS
+  AWS_DYNAMODB_ENDPOINT_URL = os.environ['AWS_DYNAMODB_ENDPOINT_URL'] \
+    if ('AWS_DYNAMODB_ENDPOINT_URL' in os.environ) else None
+
+  # Job submission limits per user, by role: token bucket size, tokens
+  # added per second, and the most PENDING/RUNNING jobs a user may have
+  GAS_SUBMISSION_LIMITS = {
+    'free_user': {'capacity': 5, 'refill_rate': 5 / 3600,
+      'max_concurrent_jobs': 2},
+    'premium_user': {'capacity': 50, 'refill_rate': 50 / 3600,
+      'max_concurrent_jobs': 10}
+  }
+  # Token buckets shared by all users of a role
+  GAS_ROLE_SUBMISSION_LIMITS = {
+    'free_user': {'capacity': 200, 'refill_rate': 0.5},
+    'premium_user': {'capacity': 1000, 'refill_rate': 5}
+  }
+  # Retry-After (in seconds) when the concurrent job cap is reached
+  GAS_CONCURRENT_JOBS_RETRY_AFTER = 60
 
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "maxinexu@mpcs-cc.com"
 
-  # Time before free user results are archived (in seconds)
-  FREE_USER_DATA_RETENTION = 300
+  # Profile data cached in the session is trusted for this long (in
+  # seconds); bump the version to invalidate every cached profile
+  GAS_PROFILE_CACHE_TTL = 900
+  GAS_PROFILE_CACHE_VERSION = 1
+
+  # Minimum time between priority restore requests for one archived job
+  # (in seconds), however often its detail page is viewed
+  GAS_JOB_RESTORE_REQUEST_INTERVAL = 900
+
+  # Time before free user results are archived (in seconds), and the
+  # number of retention_index shards jobs are spread over
+  FREE_USER_DATA_RETENTION = ann_config.getint('retention', 'free_user')
+  GAS_RETENTION_SHARDS = ann_config.getint('retention', 'Shards')
 
 class DevelopmentConfig(Config):
   DEBUG = True
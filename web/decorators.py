@@ -11,8 +11,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 from flask import redirect, request, session, url_for
 from functools import wraps
 
-from gas import db
-from models import Profile
+from helpers import get_cached_profile
 
 """Mark a route as requiring authentication
 """
@@ -38,8 +37,8 @@ Subscriber must have profile.role = premium_user
 def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
-    # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
+    # Check if user is a subscriber; the role is usually cached in the session
+    profile = get_cached_profile(identity_id=session.get('primary_identity'))
     if not profile:
       # Force login
       return redirect(url_for('login', next=request.url))
@@ -10,9 +10,16 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import re
 import json
+import time
+import boto3
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import request, render_template
-from threading import Lock
+from botocore.client import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from flask import request, render_template, session
+from threading import Lock, Thread, local
+from types import SimpleNamespace
 
 import globus_sdk
 
@@ -22,6 +29,8 @@ except:
   from urlparse import urlparse, urljoin
 
 from gas import app, db
+from models import Profile
+from replicas import read_only
 
 """Create an AuthClient for the GAS app
 """
@@ -55,26 +64,58 @@ def get_safe_redirect():
 """Grant access token to GAS app
 Uses the client_credentials grant to get access tokens 
 on the GAS's "client identity"
+
+Tokens are cached per scope set. Unexpired tokens are returned without
+taking a lock; once they are within GAS_PORTAL_TOKEN_REFRESH_AHEAD
+seconds of expiring, one background refresh replaces them.
 """
 def get_portal_tokens(scopes=None):
   scopes = scopes or \
     ['openid','urn:globus:auth:scope:demo-resource-server:all']
+  scope_key = ' '.join(sorted(set(scopes)))
+
+  entry = get_portal_tokens.cache.get(scope_key)
+  now = time.time()
+  if entry and now < entry['expires_at']:
+    if now >= entry['expires_at'] - app.config['GAS_PORTAL_TOKEN_REFRESH_AHEAD']:
+      refresh_portal_tokens_async(scope_key)
+    return entry['access_tokens']
+
+  # Nothing usable cached; wait for a (single) refresh
+  return refresh_portal_tokens(scope_key)['access_tokens']
+
+"""Get one lock per scope set, so refreshes are single-flight
+"""
+def get_portal_tokens_lock(scope_key):
   with get_portal_tokens.lock:
-    if not get_portal_tokens.access_tokens:
-      get_portal_tokens.access_tokens = {}
+    return get_portal_tokens.locks.setdefault(scope_key, Lock())
 
-    scope_string = ' '.join(scopes)
+"""Request new tokens for a scope set and cache them
+Callers that waited on the lock while another thread refreshed get the
+fresh tokens without a second round trip to Globus Auth.
+"""
+def refresh_portal_tokens(scope_key, blocking=True):
+  lock = get_portal_tokens_lock(scope_key)
+  if not lock.acquire(blocking):
+    return get_portal_tokens.cache.get(scope_key)
+
+  try:
+    entry = get_portal_tokens.cache.get(scope_key)
+    if entry and time.time() < entry['expires_at'] - \
+      app.config['GAS_PORTAL_TOKEN_REFRESH_AHEAD']:
+      return entry
 
     client = load_portal_client()
     tokens = client.oauth2_client_credentials_tokens(
-      requested_scopes=scope_string
+      requested_scopes=scope_key
     )
 
     # Walk all resource servers in the token response (includes the
     # top-level server, as found in tokens.resource_server), and store the
     # relevant Access Tokens
+    access_tokens = {}
     for resource_server, token_info in tokens.by_resource_server.items():
-      get_portal_tokens.access_tokens.update({
+      access_tokens.update({
         resource_server: {
           'token': token_info['access_token'],
           'scope': token_info['scope'],
@@ -82,9 +123,177 @@ def get_portal_tokens(scopes=None):
         }
       })
 
-    return get_portal_tokens.access_tokens
+    entry = {
+      'access_tokens': access_tokens,
+      'expires_at': min(info['expires_at'] for info in access_tokens.values())
+    }
+    # Replacing the dict entry is atomic, so lock-free readers see either
+    # the old tokens or the new ones
+    get_portal_tokens.cache[scope_key] = entry
+    return entry
+
+  finally:
+    lock.release()
+
+"""Refresh tokens in a background thread, unless a refresh is running
+"""
+def refresh_portal_tokens_async(scope_key):
+  if get_portal_tokens_lock(scope_key).locked():
+    return
+
+  def refresh():
+    try:
+      refresh_portal_tokens(scope_key, blocking=False)
+    except globus_sdk.GlobusAPIError as e:
+      app.logger.error(f"Unable to refresh portal tokens: {e}")
+
+  Thread(target=refresh, daemon=True).start()
 
 get_portal_tokens.lock = Lock()
-get_portal_tokens.access_tokens = None
+get_portal_tokens.locks = {}
+get_portal_tokens.cache = {}
+
+"""Profile fields cached in the signed session cookie
+"""
+PROFILE_FIELDS = ('name', 'email', 'institution', 'role')
+
+"""Cache a user's profile in the session with a version stamp
+"""
+def cache_profile(profile):
+  for field in PROFILE_FIELDS:
+    session[field] = getattr(profile, field)
+  stamp_cached_profile()
+
+"""Mark the profile fields already in the session as current
+For routes (login, the profile page) that have just copied them from
+the accounts database themselves
+"""
+def stamp_cached_profile():
+  session['profile_version'] = app.config['GAS_PROFILE_CACHE_VERSION']
+  session['profile_cached_at'] = int(time.time())
+  session.pop('profile_read_primary', None)
+
+"""Change a user's role with a single UPDATE
+Invalidates the profile cached in the session when it is the user's own
+"""
+def update_profile_role(identity_id=None, role=None):
+  try:
+    db.session.query(Profile).filter_by(identity_id=identity_id).update({'role': role})
+    db.session.commit()
+  except:
+    app.logger.error('Failed to update user profile')
+    db.session.rollback()
+
+  if session.get('primary_identity') == identity_id:
+    invalidate_cached_profile()
+
+"""Force the next get_cached_profile call to go to the database
+That read goes to the primary: it must see the write that caused the
+invalidation, which a lagging replica may not have yet.
+"""
+def invalidate_cached_profile():
+  session.pop('profile_version', None)
+  session.pop('profile_cached_at', None)
+  session['profile_read_primary'] = True
+
+"""Get a user's profile, from the session if the cached copy is current
+The cached copy is trusted while its version stamp matches
+GAS_PROFILE_CACHE_VERSION and it is younger than GAS_PROFILE_CACHE_TTL;
+otherwise the profile is read from the accounts database and re-cached.
+"""
+def get_cached_profile(identity_id=None):
+  own_profile = (session.get('primary_identity') == identity_id)
+  if own_profile and \
+    session.get('profile_version') == app.config['GAS_PROFILE_CACHE_VERSION'] and \
+    time.time() - session.get('profile_cached_at', 0) < app.config['GAS_PROFILE_CACHE_TTL']:
+    return SimpleNamespace(identity_id=identity_id,
+      **{field: session.get(field) for field in PROFILE_FIELDS})
+
+  query = lambda session: \
+    session.query(Profile).filter_by(identity_id=identity_id).first()
+  if own_profile and session.get('profile_read_primary'):
+    profile = query(db.session)
+  else:
+    profile = read_only(query)
+  if profile and own_profile:
+    cache_profile(profile)
+  return profile
+
+"""Get a shared, thread-safe AWS client for a service
+Creating a client is expensive, so each process creates one per service
+(and signature version) and reuses it for every request
+"""
+def aws_client(service_name, signature_version=None):
+  key = (service_name, signature_version)
+  client = aws_client.clients.get(key)
+  if client is None:
+    # Client creation from the default session is not thread-safe
+    with aws_client.lock:
+      client = aws_client.clients.get(key)
+      if client is None:
+        client = boto3.client(service_name,
+          region_name=app.config['AWS_REGION_NAME'],
+          config=Config(signature_version=signature_version) \
+            if signature_version else None)
+        aws_client.clients[key] = client
+  return client
+
+aws_client.lock = Lock()
+aws_client.clients = {}
+
+"""Get a DynamoDB table resource for the current thread
+Resources, unlike clients, must not be shared between threads, so each
+request thread creates its tables once and reuses them
+"""
+def dynamodb_table(table_name, endpoint_url=None):
+  tables = getattr(dynamodb_table.local, 'tables', None)
+  if tables is None:
+    tables = dynamodb_table.local.tables = {}
+  key = (table_name, endpoint_url)
+  table = tables.get(key)
+  if table is None:
+    with aws_client.lock:
+      dynamo = boto3.resource('dynamodb',
+        region_name=app.config['AWS_REGION_NAME'],
+        endpoint_url=endpoint_url)
+    table = tables[key] = dynamo.Table(table_name)
+  return table
+
+dynamodb_table.local = local()
+
+"""Run independent backend calls concurrently on a shared thread pool
+Each call is a no-argument function; results are returned in order and
+the first exception raised by any call is re-raised. Calls run in a
+copy of the caller's context, so the profiler still attributes them.
+"""
+def run_concurrently(*calls):
+  futures = [run_concurrently.executor.submit(contextvars.copy_context().run, call)
+    for call in calls]
+  return [future.result() for future in futures]
+
+run_concurrently.executor = ThreadPoolExecutor(
+  max_workers=app.config['GAS_BACKEND_THREADS'],
+  thread_name_prefix='gas-backend')
+
+"""Publish a single metric data point to CloudWatch
+Metrics are best-effort: the call is made on the backend thread pool,
+off the request thread, and a failure to publish is only logged
+"""
+def put_metric(name=None, value=1, unit='Count', dimensions=None):
+  run_concurrently.executor.submit(send_metric, name, value, unit, dimensions)
+
+def send_metric(name, value, unit, dimensions):
+  try:
+    aws_client('cloudwatch').put_metric_data(
+      Namespace=app.config['AWS_CLOUDWATCH_NAMESPACE'],
+      MetricData=[{
+        'MetricName': name,
+        'Dimensions': [{'Name': k, 'Value': str(v)}
+          for k, v in (dimensions or {}).items()],
+        'Value': value,
+        'Unit': unit
+      }])
+  except (ClientError, BotoCoreError) as e:
+    app.logger.warning(f"Unable to publish metric {name}: {e}")
 
 ### EOF
@@ -0,0 +1,52 @@
+# job_stats.py
+#
+# Per-user job aggregates for the GAS
+# The web side of util/job_stats.py: counts a submission and reads a
+# user's counters with a single get_item. The annotator, run.py and the
+# archive and thaw utilities adjust the rest; the stats utility corrects
+# any drift.
+#
+##
+
+import os
+import sys
+import time
+
+from botocore.exceptions import ClientError
+
+from gas import app
+from helpers import dynamodb_table
+
+# The item layout is shared with the util writers (see util/job_counters.py);
+# appended so web modules of the same name still win
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  os.pardir, 'util'))
+from job_counters import (ACTIVE_STATUSES, active_jobs, read_counters,
+  status_counter)
+
+def get_table():
+  return dynamodb_table(app.config['AWS_DYNAMODB_JOB_STATS_TABLE'],
+    endpoint_url=app.config['AWS_DYNAMODB_ENDPOINT_URL'])
+
+"""Count a newly created (PENDING) job
+Best-effort; a lost update is corrected by the next recount
+"""
+def record_submitted(user_id):
+  try:
+    get_table().update_item(
+      Key={'user_id': user_id},
+      UpdateExpression=f"SET updated_time = :t ADD jobs_total :one, {status_counter('PENDING')} :one",
+      ExpressionAttributeValues={':one': 1, ':t': int(time.time())})
+  except ClientError as e:
+    app.logger.warning(f"Unable to update job stats for {user_id}: {e}")
+
+"""A user's job counters, or None if nothing has been counted yet
+Counters that were never adjusted are returned as 0.
+"""
+def get_job_stats(user_id):
+  item = get_table().get_item(Key={'user_id': user_id}).get('Item')
+  if item is None:
+    return None
+  return read_counters(item)
+
+### EOF
@@ -0,0 +1,200 @@
+# log_handlers.py
+#
+# Non-blocking, structured logging for the GAS web app
+# Request threads only put records on a queue; a single listener thread
+# formats them as JSON and does the file and console I/O.
+#
+##
+
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import g, has_request_context, request
+
+"""Format log records as one JSON object per line
+"""
+class JsonFormatter(logging.Formatter):
+  def __init__(self, include_source=False):
+    super().__init__()
+    self.include_source = include_source
+
+  def format(self, record):
+    entry = {
+      'time': self.formatTime(record),
+      'level': record.levelname,
+      'logger': record.name,
+      'message': record.getMessage()
+    }
+    for field in ('request_id', 'route', 'method', 'path', 'status',
+      'duration_ms'):
+      if getattr(record, field, None) is not None:
+        entry[field] = getattr(record, field)
+    if self.include_source:
+      entry['source'] = f"{record.pathname}:{record.lineno}"
+    if record.exc_info:
+      entry['exception'] = self.formatException(record.exc_info)
+    return json.dumps(entry)
+
+"""Attach the request ID and route to records logged during a request
+Runs in the request thread, before the record is queued.
+"""
+class RequestContextFilter(logging.Filter):
+  def filter(self, record):
+    if has_request_context():
+      record.request_id = g.get('request_id')
+      record.route = request.endpoint
+    return True
+
+"""Drop DEBUG records for requests that were not sampled
+The sampling decision is made once per request (see start_request), so
+a sampled request keeps all of its debug lines.
+"""
+class DebugSamplingFilter(logging.Filter):
+  def filter(self, record):
+    if record.levelno > logging.DEBUG or not has_request_context():
+      return True
+    return g.get('log_debug_sampled', True)
+
+"""Handler that skips the LogRecord copy QueueHandler.prepare makes
+The listener thread does the formatting, so the request thread only
+merges the message arguments and enqueues the record.
+"""
+class AsyncQueueHandler(QueueHandler):
+  def prepare(self, record):
+    record.msg = record.getMessage()
+    record.args = None
+    return record
+
+"""Build the queue handler and the listener that drains it
+Returns (queue_handler, listener); the caller starts the listener.
+"""
+def create_queue_logging(handlers, level=logging.INFO):
+  log_queue = queue.SimpleQueue()
+  queue_handler = AsyncQueueHandler(log_queue)
+  queue_handler.setLevel(level)
+  queue_handler.addFilter(RequestContextFilter())
+  queue_handler.addFilter(DebugSamplingFilter())
+  listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+  return queue_handler, listener
+
+"""Per-request bookkeeping, registered as a before_request hook
+"""
+def start_request(sample_rates=None, default_rate=1.0):
+  g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+  g.request_start = time.perf_counter()
+  rate = (sample_rates or {}).get(request.endpoint, default_rate)
+  g.log_debug_sampled = random.random() < rate
+
+"""Log one structured line per request, registered as an after_request hook
+"""
+def finish_request(logger, response):
+  duration_ms = (time.perf_counter() - g.get('request_start',
+    time.perf_counter())) * 1000
+  logger.info('request completed', extra={
+    'method': request.method,
+    'path': request.path,
+    'status': response.status_code,
+    'duration_ms': round(duration_ms, 2)
+  })
+  response.headers['X-Request-ID'] = g.get('request_id', '')
+  return response
+
+"""Set up logging for the GAS app
+Records go to a rotating file under GAS_LOG_FILE_PATH and to the console,
+through a queue drained by a listener thread; the app's and the WSGI
+server's loggers only enqueue. The synchronous handlers gas.py attached
+are closed and replaced. Also registers the request hooks.
+"""
+def init_logging(app):
+  # Set up a rotating file handler to write log messages to a file
+  if not os.path.exists(app.config['GAS_LOG_FILE_PATH']):
+    os.makedirs(app.config['GAS_LOG_FILE_PATH'])
+  log_file = app.config['GAS_LOG_FILE_PATH'] + "/" + app.config['GAS_LOG_FILE_NAME']
+  log_file_handler = RotatingFileHandler(log_file, maxBytes=500000, backupCount=9)
+
+  # Set up a stream handler to write log messages to the console
+  log_stream_handler = logging.StreamHandler()
+
+  # Set the appropriate log level and format for log lines
+  if (app.config['GAS_LOG_LEVEL'] == 'DEBUG'):
+    log_level = logging.DEBUG
+    log_formatter = JsonFormatter(include_source=True)
+  else:
+    log_level = logging.INFO
+    log_formatter = JsonFormatter()
+
+  log_file_handler.setFormatter(log_formatter)
+  log_stream_handler.setFormatter(log_formatter)
+
+  # Request threads only enqueue records; the listener thread does the
+  # formatting and the (blocking) file and console I/O
+  log_queue_handler, log_listener = create_queue_logging(
+    [log_file_handler, log_stream_handler], level=log_level)
+  log_listener.start()
+  atexit.register(log_listener.stop)
+
+  # The WSGI server (werkzeug, gunicorn, etc.) and Flask app loggers write
+  # only through the queue
+  logger = logging.getLogger(app.config['WSGI_SERVER'])
+  for handler in set(logger.handlers + app.logger.handlers):
+    handler.close()
+  logger.handlers = [log_queue_handler]
+  app.logger.handlers = [log_queue_handler]
+  app.logger.setLevel(log_level)
+
+  # Attach request IDs and timings, and sample noisy debug logs per route
+  @app.before_request
+  def before_request_logging():
+    start_request(sample_rates=app.config['GAS_LOG_DEBUG_SAMPLE_RATES'])
+
+  @app.after_request
+  def after_request_logging(response):
+    return finish_request(app.logger, response)
+
+  return log_listener
+
+"""Benchmark the per-call cost of the old synchronous file handler
+against the queue handler
+Usage: python log_handlers.py [iterations]
+"""
+if __name__ == '__main__':
+  import sys
+  import tempfile
+
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  log_dir = tempfile.mkdtemp()
+
+  def run(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    start = time.perf_counter()
+    for i in range(iterations):
+      logger.debug('benchmark message %d for %s', i, name)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed / iterations * 1e6:.1f} us per log call")
+
+  sync_handler = RotatingFileHandler(os.path.join(log_dir, 'sync.log'),
+    maxBytes=500000, backupCount=9)
+  sync_handler.setFormatter(logging.Formatter(
+    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+  run('sync', sync_handler)
+
+  file_handler = RotatingFileHandler(os.path.join(log_dir, 'async.log'),
+    maxBytes=500000, backupCount=9)
+  file_handler.setFormatter(JsonFormatter(include_source=True))
+  queue_handler, listener = create_queue_logging([file_handler],
+    level=logging.DEBUG)
+  listener.start()
+  run('queue', queue_handler)
+  listener.stop()
+
+### EOF
@@ -0,0 +1,143 @@
+# profiler.py
+#
+# Per-request profiling of AWS and SQL calls
+# Hooks botocore's event system to count and time every AWS operation
+# made while serving a request, and collects the SQL timings recorded by
+# replicas.py. A summary goes in the X-GAS-Profile response header (debug
+# mode only) and into a rolling per-route aggregate with percentiles.
+#
+##
+
+import time
+import threading
+import contextvars
+from collections import defaultdict, deque
+
+import boto3
+from flask import abort, g, jsonify, request
+
+# Profile of the request being served; a context variable rather than
+# flask.g so that AWS calls made from worker threads are attributed too
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+"""AWS operation counts and latencies for a single request
+"""
+class RequestProfile(object):
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.lock = threading.Lock()
+    self.aws_calls = defaultdict(lambda: [0, 0.0])
+
+  def record_aws_call(self, operation, elapsed):
+    with self.lock:
+      self.aws_calls[operation][0] += 1
+      self.aws_calls[operation][1] += elapsed
+
+"""Rolling aggregate of the last `window` requests per route
+"""
+class RouteStats(object):
+  def __init__(self, window=1000):
+    self.window = window
+    self.lock = threading.Lock()
+    self.samples = defaultdict(lambda: deque(maxlen=self.window))
+
+  def add(self, route, sample):
+    with self.lock:
+      self.samples[route].append(sample)
+
+  def summary(self):
+    with self.lock:
+      samples = {route: list(values) for route, values in self.samples.items()}
+
+    summary = {}
+    for route, values in samples.items():
+      summary[route] = {'requests': len(values)}
+      for metric in ('duration_ms', 'aws_calls', 'aws_ms', 'sql_queries',
+        'sql_ms', 'cookie_bytes', 'session_ms'):
+        summary[route][metric] = percentiles([value[metric] for value in values])
+    return summary
+
+"""Nearest-rank p50, p95 and p99 of a list of numbers
+"""
+def percentiles(values):
+  values = sorted(values)
+  return {f"p{p}": round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+    for p in (50, 95, 99)}
+
+"""botocore before-call handler; stashes the start time in the
+per-call context dict
+"""
+def before_aws_call(context=None, **kwargs):
+  if context is not None and current_profile.get() is not None:
+    context['gas_profile_start'] = time.perf_counter()
+
+"""botocore after-call / after-call-error handler
+"""
+def after_aws_call(event_name=None, context=None, **kwargs):
+  profile = current_profile.get()
+  if profile is None or context is None or 'gas_profile_start' not in context:
+    return
+  # event_name is e.g. after-call.dynamodb.Query
+  operation = event_name.split('.', 1)[1]
+  profile.record_aws_call(operation,
+    time.perf_counter() - context.pop('gas_profile_start'))
+
+"""Build the one-line summary used for the response header
+"""
+def format_summary(profile, sql_timings):
+  parts = [f"{operation}={count}/{elapsed * 1000:.1f}ms"
+    for operation, (count, elapsed) in sorted(profile.aws_calls.items())]
+  parts.append(f"sql={len(sql_timings)}/{sum(t for _, t in sql_timings) * 1000:.1f}ms")
+  return '; '.join(parts)
+
+"""Install the botocore hooks and the request hooks on the app
+"""
+def init_profiler(app):
+  route_stats = RouteStats(window=app.config['GAS_PROFILER_WINDOW'])
+
+  # Clients created with boto3.client() come from the default session
+  if boto3.DEFAULT_SESSION is None:
+    boto3.setup_default_session(region_name=app.config['AWS_REGION_NAME'])
+  events = boto3.DEFAULT_SESSION.events
+  events.register('before-call.*.*', before_aws_call)
+  events.register('after-call.*.*', after_aws_call)
+  events.register('after-call-error.*.*', after_aws_call)
+
+  @app.before_request
+  def start_profile():
+    g.profile_token = current_profile.set(RequestProfile())
+
+  @app.after_request
+  def finish_profile(response):
+    profile = current_profile.get()
+    if profile is None:
+      return response
+    current_profile.reset(g.pop('profile_token'))
+
+    sql_timings = g.get('sql_timings', [])
+    route_stats.add(request.endpoint, {
+      'duration_ms': (time.perf_counter() - profile.start) * 1000,
+      'aws_calls': sum(count for count, _ in profile.aws_calls.values()),
+      'aws_ms': sum(elapsed for _, elapsed in profile.aws_calls.values()) * 1000,
+      'sql_queries': len(sql_timings),
+      'sql_ms': sum(elapsed for _, elapsed in sql_timings) * 1000,
+      'cookie_bytes': g.get('session_cookie_bytes', 0),
+      'session_ms': g.get('session_load_ms', 0)
+    })
+
+    if app.debug:
+      response.headers['X-GAS-Profile'] = format_summary(profile, sql_timings) + \
+        f"; cookie={g.get('session_cookie_bytes', 0)}B/{g.get('session_load_ms', 0):.2f}ms"
+    return response
+
+  """Rolling per-route p50/p95/p99 (debug mode only)
+  """
+  @app.route('/debug/profile', methods=['GET'])
+  def profile_summary():
+    if not app.debug:
+      abort(404)
+    return jsonify(route_stats.summary())
+
+  return route_stats
+
+### EOF
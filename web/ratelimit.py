@@ -0,0 +1,151 @@
+# ratelimit.py
+#
+# Job submission limits for the GAS
+# Token buckets per user and per role, plus a cap on concurrent jobs.
+# Buckets live in a DynamoDB table so that all web servers share them;
+# point AWS_DYNAMODB_ENDPOINT_URL at DynamoDB Local to run without AWS.
+#
+##
+
+import math
+import time
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from flask import make_response, render_template
+
+from gas import app
+from helpers import dynamodb_table
+from job_stats import ACTIVE_STATUSES, active_jobs, get_job_stats
+
+"""Take one token from a bucket
+Returns 0 if a token was taken, otherwise the number of seconds until
+the next token becomes available
+"""
+def take_token(table, bucket_id, capacity, refill_rate, now=None):
+  now = now or time.time()
+
+  # Optimistic concurrency: retry if another server updated the bucket
+  # between our read and our write
+  for attempt in range(5):
+    item = table.get_item(Key={'bucket_id': bucket_id},
+      ConsistentRead=True).get('Item')
+    if item:
+      tokens = float(item['tokens'])
+      updated_at = item['updated_at']
+      tokens = min(capacity, tokens + (now - float(updated_at)) * refill_rate)
+    else:
+      tokens = capacity
+      updated_at = None
+
+    if tokens < 1:
+      return (1 - tokens) / refill_rate
+
+    condition = Attr('bucket_id').not_exists() if updated_at is None \
+      else Attr('updated_at').eq(updated_at)
+    try:
+      table.put_item(
+        Item={
+          'bucket_id': bucket_id,
+          'tokens': Decimal(str(round(tokens - 1, 6))),
+          'updated_at': Decimal(str(round(now, 6))),
+          # Full buckets carry no state; let DynamoDB TTL remove them
+          'expires_at': int(now + capacity / refill_rate) + 60
+        },
+        ConditionExpression=condition)
+      return 0
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+
+  # Heavily contended bucket; ask the caller to come back shortly
+  return 1
+
+"""Put back a token taken for a submission that did not go ahead
+Buckets that are missing or already full are left alone.
+"""
+def give_back_token(table, bucket_id, capacity):
+  try:
+    table.update_item(
+      Key={'bucket_id': bucket_id},
+      UpdateExpression='ADD tokens :one',
+      ConditionExpression=Attr('tokens').lte(Decimal(str(capacity - 1))),
+      ExpressionAttributeValues={':one': 1})
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+
+"""Count a user's jobs that are still waiting for or holding an annotator
+Read from the user's job aggregates; users with none yet are counted
+from their jobs.
+"""
+def count_active_jobs(user_id):
+  stats = get_job_stats(user_id)
+  if stats is not None:
+    return active_jobs(stats)
+
+  table = dynamodb_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    endpoint_url=app.config['AWS_DYNAMODB_ENDPOINT_URL'])
+
+  count = 0
+  kwargs = {
+    'IndexName': 'user_id_index',
+    'KeyConditionExpression': Key('user_id').eq(user_id),
+    'FilterExpression': Attr('job_status').is_in(list(ACTIVE_STATUSES)),
+    'Select': 'COUNT'
+  }
+  while True:
+    response = table.query(**kwargs)
+    count += response['Count']
+    if 'LastEvaluatedKey' not in response:
+      return count
+    kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""Check whether a user may submit another annotation job
+Returns 0 if the submission is allowed, otherwise the number of seconds
+after which the caller should retry
+"""
+def check_submission_limits(user_id=None, role=None):
+  limits = app.config['GAS_SUBMISSION_LIMITS'].get(role,
+    app.config['GAS_SUBMISSION_LIMITS']['free_user'])
+  role_limits = app.config['GAS_ROLE_SUBMISSION_LIMITS'].get(role,
+    app.config['GAS_ROLE_SUBMISSION_LIMITS']['free_user'])
+
+  try:
+    if count_active_jobs(user_id) >= limits['max_concurrent_jobs']:
+      return app.config['GAS_CONCURRENT_JOBS_RETRY_AFTER']
+
+    table = dynamodb_table(app.config['AWS_DYNAMODB_RATE_LIMITS_TABLE'],
+      endpoint_url=app.config['AWS_DYNAMODB_ENDPOINT_URL'])
+
+    retry_after = take_token(table, f"user:{user_id}",
+      limits['capacity'], limits['refill_rate'])
+    if retry_after:
+      return retry_after
+
+    retry_after = take_token(table, f"role:{role}",
+      role_limits['capacity'], role_limits['refill_rate'])
+    if retry_after:
+      # The submission is refused, so the user's token was not used
+      give_back_token(table, f"user:{user_id}", limits['capacity'])
+    return retry_after
+
+  except ClientError as e:
+    # Never lock users out because the limits table is unavailable
+    app.logger.error(f"Unable to check submission limits for {user_id}: {e}")
+    return 0
+
+"""The 429 response for a submission refused by check_submission_limits
+"""
+def too_many_requests(retry_after):
+  retry_after = int(math.ceil(retry_after))
+  response = make_response(render_template('error.html',
+    title='Too many requests', alert_level='warning',
+    message=f"You have submitted too many annotation requests. \
+      Please try again in {retry_after} seconds."
+    ), 429)
+  response.headers['Retry-After'] = str(retry_after)
+  return response
+
+### EOF
@@ -0,0 +1,83 @@
+# replicas.py
+#
+# Route read-only accounts database queries to read replicas
+# Falls back to the primary (the Flask-SQLAlchemy session) when no
+# replica is configured or reachable. Also records per-query latency
+# for every engine, primary included.
+#
+##
+
+import time
+import random
+
+from flask import g, has_request_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from gas import app, db
+
+replica_engines = [create_engine(uri, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+  for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+
+# Replicas that failed recently are skipped until this time
+replica_down_until = {}
+
+"""Run a read-only query function against a replica
+query_fn receives a SQLAlchemy session and returns the result. Replicas
+are tried in random order; unreachable ones are skipped for
+SQLALCHEMY_REPLICA_RETRY_SECONDS. Returns (result, used_replica).
+"""
+def read_from_replica(query_fn):
+  now = time.time()
+  engines = [engine for engine in replica_engines
+    if replica_down_until.get(engine, 0) <= now]
+  random.shuffle(engines)
+
+  for engine in engines:
+    session = Session(bind=engine)
+    try:
+      # Objects stay usable (detached) after the session is closed
+      return query_fn(session), True
+    except OperationalError as e:
+      app.logger.warning(f"Accounts replica {engine.url.host} unavailable: {e}")
+      replica_down_until[engine] = now + app.config['SQLALCHEMY_REPLICA_RETRY_SECONDS']
+    finally:
+      session.close()
+
+  return query_fn(db.session), False
+
+"""Run a read-only query function on a replica, falling back to the
+primary if no replica can serve it or the replica has no result yet
+(e.g. a profile created moments ago that has not replicated)
+"""
+def read_only(query_fn):
+  result, used_replica = read_from_replica(query_fn)
+  if result is None and used_replica:
+    result = query_fn(db.session)
+  return result
+
+"""Record the latency of every SQL statement
+Timings go to the debug log, and to the request's g.sql_timings list
+when there is one; statements slower than SQLALCHEMY_SLOW_QUERY_SECONDS
+are logged as warnings.
+"""
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+  host = conn.engine.url.host
+  if has_request_context():
+    g.setdefault('sql_timings', []).append((host, elapsed))
+
+  message = f"SQL on {host} took {elapsed * 1000:.2f}ms: {statement[:200]}"
+  if elapsed > app.config['SQLALCHEMY_SLOW_QUERY_SECONDS']:
+    app.logger.warning(message)
+  else:
+    app.logger.debug(message)
+
+### EOF
@@ -15,10 +15,20 @@ if [ "$1" = "console" ]; then
 else
     LOG_TARGET=/home/ec2-user/mpcs-cc/gas/web/log/$GAS_LOG_FILE_NAME
 fi
+# Workers share Secrets Manager values through an encrypted cache only
+# when .env sets GAS_SECRETS_CACHE_KEY to a Fernet key, e.g. from
+#   python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+if [ -z "$GAS_SECRETS_CACHE_KEY" ]; then
+    echo "GAS_SECRETS_CACHE_KEY is not set; each worker will load secrets from ASM" >&2
+fi
+# Fingerprint and precompress static assets before serving
+/home/ec2-user/mpcs-cc/bin/python build_assets.py
 /home/ec2-user/mpcs-cc/bin/gunicorn \
   --log-file=$LOG_TARGET \
-  --log-level=debug \
+  --log-level=${GAS_LOG_LEVEL:-info} \
   --workers=$GUNICORN_WORKERS \
+  --worker-class=gthread \
+  --threads=${GUNICORN_THREADS:-4} \
   --certfile=$SSL_CERT_PATH \
   --keyfile=$SSL_KEY_PATH \
   --bind=$GAS_APP_HOST:$GAS_HOST_PORT gas:app
@@ -0,0 +1,192 @@
+# secrets_provider.py
+#
+# Load GAS credentials from AWS Secrets Manager in a single batched call
+# and share them between gunicorn workers through an encrypted local
+# cache file, so only the first worker to boot pays for the round trip
+#
+##
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+import boto3
+from botocore.exceptions import ClientError
+
+try:
+  from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+  Fernet = None
+
+"""Fetch all of the given secrets with BatchGetSecretValue
+Returns a dict of secret ID -> parsed SecretString
+"""
+def fetch_secrets(secret_ids, region_name=None):
+  asm = boto3.client('secretsmanager', region_name=region_name)
+
+  secrets = {}
+  kwargs = {'SecretIdList': list(secret_ids)}
+  # Source: https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_BatchGetSecretValue.html
+  while True:
+    response = asm.batch_get_secret_value(**kwargs)
+    for error in response.get('Errors', []):
+      raise ClientError({'Error': {
+        'Code': error['ErrorCode'],
+        'Message': f"{error['SecretId']}: {error['Message']}"}},
+        'BatchGetSecretValue')
+    for secret in response['SecretValues']:
+      secrets[secret['Name']] = json.loads(secret['SecretString'])
+    if not response.get('NextToken'):
+      break
+    kwargs['NextToken'] = response['NextToken']
+
+  missing = set(secret_ids) - set(secrets)
+  if missing:
+    raise ClientError({'Error': {'Code': 'ResourceNotFoundException',
+      'Message': f"Secrets not returned: {', '.join(sorted(missing))}"}},
+      'BatchGetSecretValue')
+  return secrets
+
+"""Secrets Manager values cached in an encrypted file with a TTL
+Caching is skipped (every load goes to Secrets Manager) unless a Fernet
+key is configured and the cryptography package is installed; check
+caching before relying on the shared cache.
+"""
+class SecretsProvider(object):
+  def __init__(self, secret_ids, region_name=None, cache_path=None,
+    cache_key=None, ttl=3600):
+    self.secret_ids = sorted(secret_ids)
+    self.region_name = region_name
+    self.cache_path = cache_path
+    self.lock_path = f"{cache_path}.lock"
+    self.ttl = ttl
+    self.fernet = Fernet(cache_key) \
+      if (Fernet and cache_key and cache_path) else None
+
+  @property
+  def caching(self):
+    return self.fernet is not None
+
+  def read_cache(self):
+    if not self.fernet:
+      return None
+    try:
+      with open(self.cache_path, 'rb') as f:
+        cached = json.loads(self.fernet.decrypt(f.read()))
+    except (OSError, ValueError, InvalidToken):
+      return None
+
+    if cached['secret_ids'] != self.secret_ids or \
+      time.time() - cached['fetched_at'] > self.ttl:
+      return None
+    return cached
+
+  def write_cache(self, secrets):
+    if not self.fernet:
+      return
+    payload = json.dumps({
+      'secret_ids': self.secret_ids,
+      'fetched_at': time.time(),
+      'secrets': secrets
+    }).encode('utf-8')
+
+    # Write then rename so other workers never read a partial file
+    tmp_path = f"{self.cache_path}.{os.getpid()}"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(self.fernet.encrypt(payload))
+    os.replace(tmp_path, self.cache_path)
+
+  def refresh(self):
+    secrets = fetch_secrets(self.secret_ids, region_name=self.region_name)
+    self.write_cache(secrets)
+    return secrets
+
+  """Secrets from the cache file, or from Secrets Manager if it is stale
+  On a cold start the workers booting together queue on the refresher's
+  lock file, so only the first one calls Secrets Manager and the rest
+  read the cache it wrote.
+  """
+  def load(self):
+    cached = self.read_cache()
+    if cached:
+      return cached['secrets']
+    if not self.fernet:
+      return self.refresh()
+
+    with open(self.lock_path, 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      cached = self.read_cache()
+      if cached:
+        return cached['secrets']
+      return self.refresh()
+
+  """Refresh the cache file in the background before it expires
+  A lock file makes sure only one process on the host does the refresh.
+  Failures are logged and retried after retry_delay seconds; the thread
+  never exits while the worker is running.
+  Only the cache file is refreshed: a running worker keeps the values it
+  loaded at boot (they are baked into SECRET_KEY and the database
+  engines), so a rotated secret reaches a worker when gunicorn restarts it.
+  Returns None, with no thread started, when caching is off.
+  """
+  def start_refresher(self, logger=None, retry_delay=30):
+    if not self.fernet:
+      return None
+
+    def run():
+      while True:
+        try:
+          cached = self.read_cache()
+          age = (time.time() - cached['fetched_at']) if cached else self.ttl
+          time.sleep(max(self.ttl * 0.8 - age, 1))
+          with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            cached = self.read_cache()
+            if not cached or \
+              time.time() - cached['fetched_at'] > self.ttl * 0.8:
+              self.refresh()
+        except BlockingIOError:
+          # Another worker is refreshing
+          pass
+        except Exception as e:
+          if logger:
+            logger.error(f"Unable to refresh secrets cache: {e}")
+          time.sleep(retry_delay)
+
+    thread = threading.Thread(target=run, name='secrets-refresher',
+      daemon=True)
+    thread.start()
+    return thread
+
+"""Compare startup secret loading: three sequential GetSecretValue calls
+(the previous behavior) against one batched call and a warm cache
+Usage: python secrets_provider.py
+"""
+if __name__ == '__main__':
+  region_name = os.environ.get('AWS_REGION_NAME', 'us-east-1')
+  secret_ids = ['gas/web_server', 'rds/accounts_database', 'globus/auth_client']
+
+  start = time.time()
+  asm = boto3.client('secretsmanager', region_name=region_name)
+  for secret_id in secret_ids:
+    json.loads(asm.get_secret_value(SecretId=secret_id)['SecretString'])
+  print(f"Sequential GetSecretValue: {time.time() - start:.3f}s")
+
+  start = time.time()
+  fetch_secrets(secret_ids, region_name=region_name)
+  print(f"BatchGetSecretValue: {time.time() - start:.3f}s")
+
+  if Fernet:
+    provider = SecretsProvider(secret_ids, region_name=region_name,
+      cache_path='/tmp/gas_secrets_bench.cache',
+      cache_key=Fernet.generate_key())
+    provider.refresh()
+    start = time.time()
+    provider.load()
+    print(f"Warm encrypted cache: {time.time() - start:.3f}s")
+    os.remove('/tmp/gas_secrets_bench.cache')
+
+### EOF
@@ -0,0 +1,213 @@
+# sessions.py
+#
+# Server-side session storage for the GAS
+# With a server-side backend the session cookie carries only a signed
+# session ID; the session data (Globus tokens, profile fields) lives in
+# an in-process LRU (single node) or a DynamoDB table (whole fleet).
+# Cookie size and session load time are recorded for every request.
+#
+##
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+from flask import g
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import (SessionInterface, SessionMixin,
+  SecureCookieSessionInterface)
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+serializer = TaggedJSONSerializer()
+
+"""Session whose data is kept on the server
+"""
+class ServerSideSession(CallbackDict, SessionMixin):
+  def __init__(self, initial=None, sid=None, new=False):
+    def on_update(self):
+      self.modified = True
+    super().__init__(initial, on_update)
+    self.sid = sid
+    self.new = new
+    self.modified = False
+    # Set by regenerate(); that ID is removed from the store on save
+    self.previous_sid = None
+
+  """Move the session to a new ID, keeping its data
+  Call when the session becomes authenticated, so an ID planted or seen
+  before login is worthless afterwards (session fixation).
+  """
+  def regenerate(self):
+    if self.previous_sid is None and not self.new:
+      self.previous_sid = self.sid
+    self.sid = uuid.uuid4().hex
+    self.modified = True
+
+"""In-process LRU store; sessions are lost on restart and not shared
+between workers, so only suitable for single-process deployments
+"""
+class MemorySessionStore(object):
+  def __init__(self, max_entries=10000):
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+
+  def get(self, sid):
+    with self.lock:
+      entry = self.entries.get(sid)
+      if entry is None:
+        return None
+      if entry[1] < time.time():
+        del self.entries[sid]
+        return None
+      self.entries.move_to_end(sid)
+      return entry[0]
+
+  def put(self, sid, data, expires_at):
+    with self.lock:
+      self.entries[sid] = (data, expires_at)
+      self.entries.move_to_end(sid)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def delete(self, sid):
+    with self.lock:
+      self.entries.pop(sid, None)
+
+"""DynamoDB store shared by every web server
+Expired items are removed by DynamoDB TTL on the expires_at attribute.
+Resources must not be shared between threads, so each request thread
+gets its own table.
+"""
+class DynamoDBSessionStore(object):
+  def __init__(self, table_name, region_name=None, endpoint_url=None):
+    self.table_name = table_name
+    self.region_name = region_name
+    self.endpoint_url = endpoint_url
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  @property
+  def table(self):
+    table = getattr(self.local, 'table', None)
+    if table is None:
+      # Resource creation from the default session is not thread-safe
+      with self.lock:
+        table = boto3.resource('dynamodb', region_name=self.region_name,
+          endpoint_url=self.endpoint_url).Table(self.table_name)
+      self.local.table = table
+    return table
+
+  def get(self, sid):
+    item = self.table.get_item(Key={'session_id': sid}).get('Item')
+    if item is None or item['expires_at'] < time.time():
+      return None
+    return item['data']
+
+  def put(self, sid, data, expires_at):
+    self.table.put_item(Item={
+      'session_id': sid,
+      'data': data,
+      'expires_at': int(expires_at)
+    })
+
+  def delete(self, sid):
+    self.table.delete_item(Key={'session_id': sid})
+
+"""Session interface that keeps only a signed session ID in the cookie
+"""
+class ServerSideSessionInterface(SessionInterface):
+  def __init__(self, store):
+    self.store = store
+
+  def get_signer(self, app):
+    return Signer(app.secret_key, salt='gas-session-id')
+
+  def open_session(self, app, request):
+    start = time.perf_counter()
+    g.session_cookie_bytes = len(request.headers.get('Cookie', ''))
+
+    session = None
+    cookie = request.cookies.get(self.get_cookie_name(app))
+    if cookie:
+      try:
+        sid = self.get_signer(app).unsign(cookie).decode('utf-8')
+        data = self.store.get(sid)
+        if data is not None:
+          session = ServerSideSession(serializer.loads(data), sid=sid)
+      except (BadSignature, ClientError) as e:
+        app.logger.warning(f"Unable to load session: {e}")
+
+    if session is None:
+      session = ServerSideSession(sid=uuid.uuid4().hex, new=True)
+    g.session_load_ms = (time.perf_counter() - start) * 1000
+    return session
+
+  def save_session(self, app, session, response):
+    domain = self.get_cookie_domain(app)
+    path = self.get_cookie_path(app)
+    name = self.get_cookie_name(app)
+
+    if session.previous_sid is not None:
+      self.store.delete(session.previous_sid)
+      session.previous_sid = None
+
+    if not session:
+      if session.modified:
+        self.store.delete(session.sid)
+        response.delete_cookie(name, domain=domain, path=path)
+      return
+
+    if not (session.modified or session.new or
+      self.should_set_cookie(app, session)):
+      return
+
+    expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+    if session.modified or session.new or session.permanent:
+      self.store.put(session.sid, serializer.dumps(dict(session)), expires_at)
+
+    response.set_cookie(name,
+      self.get_signer(app).sign(session.sid.encode('utf-8')).decode('utf-8'),
+      expires=self.get_expiration_time(app, session),
+      httponly=self.get_cookie_httponly(app),
+      domain=domain, path=path,
+      secure=self.get_cookie_secure(app),
+      samesite=self.get_cookie_samesite(app))
+
+"""Give the current session a new ID, if it has one
+Signed-cookie sessions carry their data rather than an ID, so there is
+nothing to regenerate.
+"""
+def regenerate_session(session):
+  if isinstance(session, ServerSideSession):
+    session.regenerate()
+
+"""Flask's signed-cookie sessions, with the same measurements recorded
+"""
+class MeasuredCookieSessionInterface(SecureCookieSessionInterface):
+  def open_session(self, app, request):
+    start = time.perf_counter()
+    g.session_cookie_bytes = len(request.headers.get('Cookie', ''))
+    session = super().open_session(app, request)
+    g.session_load_ms = (time.perf_counter() - start) * 1000
+    return session
+
+"""Build the session interface selected by GAS_SESSION_BACKEND
+"""
+def create_session_interface(app):
+  backend = app.config['GAS_SESSION_BACKEND']
+  if backend == 'memory':
+    return ServerSideSessionInterface(
+      MemorySessionStore(max_entries=app.config['GAS_SESSION_MEMORY_MAX_ENTRIES']))
+  elif backend == 'dynamodb':
+    return ServerSideSessionInterface(
+      DynamoDBSessionStore(app.config['AWS_DYNAMODB_SESSIONS_TABLE'],
+        region_name=app.config['AWS_REGION_NAME'],
+        endpoint_url=app.config['AWS_DYNAMODB_ENDPOINT_URL']))
+  return MeasuredCookieSessionInterface()
+
+### EOF
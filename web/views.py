@@ -12,11 +12,13 @@ import uuid
 import time
 import json
 import re
+import zlib
 import botocore
 from datetime import datetime
 
 import boto3
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
@@ -25,12 +27,23 @@ from flask import (abort, flash, redirect, render_template,
 
 from gas import app, db
 from decorators import authenticated, is_premium
-from auth import get_profile, update_profile
+from ratelimit import check_submission_limits, too_many_requests
+from auth import get_profile
+from helpers import (put_metric, aws_client, dynamodb_table, run_concurrently,
+  update_profile_role)
+from job_stats import record_submitted, get_job_stats
+from app_setup import init_app
+
+# Logging, sessions, assets, profiling and login hooks (see app_setup.py)
+init_app(app)
 
 
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
 uploading an annotation input file using the policy document.
+Submission limits are checked here, before the upload policy is issued:
+this is the request the user makes for every job, whether the job is
+then created from the upload notification or from the redirect.
 
 Note: You are welcome to use this code instead of your own
 but you can replace the code below with your own if you prefer.
@@ -38,10 +51,13 @@ but you can replace the code below with your own if you prefer.
 @app.route('/annotate', methods=['GET'])
 @authenticated
 def annotate():
+  retry_after = check_submission_limits(
+    user_id=session.get('primary_identity'), role=session.get('role'))
+  if retry_after:
+    return too_many_requests(retry_after)
+
   # Create a session client to the S3 service
-  s3 = boto3.client('s3',
-    region_name=app.config['AWS_REGION_NAME'],
-    config=Config(signature_version='s3v4'))
+  s3 = aws_client('s3', signature_version='s3v4')
 
   bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   user_id = session['primary_identity']
@@ -87,6 +103,9 @@ Accepts the S3 redirect GET request, parses it to extract
 required info, saves a job item to the database, and then
 publishes a notification for the annotator service.
 
+When AWS_S3_EVENT_SUBMISSION is set, jobs are created by the submit
+utility from S3 upload notifications and this page only shows status.
+
 Note: Update/replace the code below with your own from previous
 homework assignments
 """
@@ -112,6 +131,26 @@ def create_annotation_job_request():
     id = match.group(3)
     filename = match.group(4)
 
+    if match.group(2) != user:
+        abort(403)
+
+    if app.config['AWS_S3_EVENT_SUBMISSION']:
+        # The upload notification creates the job; just report its status
+        try:
+            table = dynamodb_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+            item = table.get_item(Key={'job_id': id},
+                ProjectionExpression='job_status').get('Item')
+
+        except botocore.exceptions.ClientError:
+            return jsonify({
+                'code': 500,
+                'status': 'error',
+                'message': 'Dynamodb Error: Job status could not be read.'
+            })
+
+        job_status = item['job_status'] if item else 'SUBMITTED'
+        return render_template('annotate_confirm.html', job_id=id, job_status=job_status)
+
     # Persist job to database
     data = {"job_id": id,
             "user_id": user,
@@ -123,23 +162,35 @@ def create_annotation_job_request():
             }
 
     try:
-        db = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-        table = db.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        table = dynamodb_table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+        # Only the first submission for a job ID creates the job; reloads
+        # of this page must not queue the same annotation again
         # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/put_item.html
-        table.put_item(Item=data)
+        table.put_item(Item=data, ConditionExpression='attribute_not_exists(job_id)')
+        record_submitted(user)
+
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            return jsonify({
+                'code': 500,
+                'status': 'error',
+                'message': 'Dynamodb Error: File information could not be entered.'
+            })
 
-    except botocore.exceptions.ClientError:
-        return jsonify({
-            'code': 500,
-            'status': 'error',
-            'message': 'Dynamodb Error: File information could not be entered.'
-        })
+        item = table.get_item(Key={'job_id': id}, ConsistentRead=True,
+            ProjectionExpression='job_status, published').get('Item', {})
+        if item.get('job_status') != 'PENDING' or item.get('published'):
+            put_metric(name='DuplicateJobsPrevented', dimensions={'Stage': 'web'})
+            return render_template('annotate_confirm.html', job_id=id,
+                job_status=item.get('job_status', data['job_status']))
+        # The job was created but its request was never published, e.g. the
+        # publish failed; a concurrent first publish is dropped by the topic's
+        # deduplication on the job ID
 
     # Send message to request queue
     try:
         # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-        sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
-        sns.publish(
+        aws_client('sns').publish(
             TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
             Message=json.dumps(data),
             MessageGroupId='jobRequestsGroup',
@@ -153,7 +204,15 @@ def create_annotation_job_request():
             'message': 'SNS Error: {}'.format(str(e))
         })
 
-    return render_template('annotate_confirm.html', job_id=id)
+    # Reloads of this page only publish jobs that are not marked
+    try:
+        table.update_item(Key={'job_id': id},
+            UpdateExpression='SET published = :t',
+            ExpressionAttributeValues={':t': True})
+    except botocore.exceptions.ClientError as e:
+        app.logger.warning('Unable to mark job {} published: {}'.format(id, e))
+
+    return render_template('annotate_confirm.html', job_id=id, job_status=data['job_status'])
 
 
 """List all annotations for the user
@@ -161,7 +220,7 @@ def create_annotation_job_request():
 @app.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
-    db = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    db = aws_client('dynamodb')
     try:
         # Getting annotations from Dynamo table
         response = db.query(
@@ -191,31 +250,132 @@ def annotations_list():
             'input_file_name': item['input_file_name']['S'],
             'job_status': item['job_status']['S']
         }
-	for item in response['Items']
+        for item in response['Items']
     ]
 
     return render_template('annotations.html', annotations=cleaned_list)
 
+"""Summarize the user's jobs and stored results
+Reads the user's job aggregates (a single item) rather than their jobs
+"""
+@app.route('/dashboard', methods=['GET'])
+@authenticated
+def dashboard():
+    try:
+        stats = get_job_stats(session['primary_identity'])
+    except ClientError as e:
+        return jsonify({
+            'code': 500,
+            'status': 'error',
+            'message': 'Dynamodb Error: Job summary could not be read. Try again'
+        })
+    return render_template('dashboard.html', stats=stats)
+
+"""Ask the restore utility to bring back one archived result first
+At most one request per job every GAS_JOB_RESTORE_REQUEST_INTERVAL
+seconds, however often the page is viewed; the restore utility skips
+jobs that already have an Expedited retrieval in flight.
+Returns True if a request is in flight, whether sent now or earlier in
+the interval, and False if it could not be sent.
+"""
+def request_job_restore(user, id):
+  db = aws_client('dynamodb')
+  now = int(time.time())
+  try:
+    db.update_item(
+      TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+      Key={'job_id': {'S': id}},
+      UpdateExpression='SET restore_requested_time = :now',
+      ConditionExpression='user_id = :u AND (attribute_not_exists(restore_requested_time) OR restore_requested_time < :cutoff)',
+      ExpressionAttributeValues={
+        ':now': {'N': str(now)},
+        ':u': {'S': user},
+        ':cutoff': {'N': str(now - app.config['GAS_JOB_RESTORE_REQUEST_INTERVAL'])}
+      }
+    )
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+      # Already requested within the interval
+      return True
+    app.logger.warning('Unable to request restore of {}: {}'.format(id, e))
+    return False
+
+  try:
+    aws_client('sqs').send_message(
+      QueueUrl=app.config['AWS_SQS_RESTORE_QUEUE'],
+      MessageBody=json.dumps({'user_id': user, 'job_id': id})
+    )
+  except ClientError as e:
+    app.logger.warning('Unable to request restore of {}: {}'.format(id, e))
+    # Nothing was sent, so let the next view of the page ask again
+    try:
+      db.update_item(
+        TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+        Key={'job_id': {'S': id}},
+        UpdateExpression='REMOVE restore_requested_time',
+        ConditionExpression='restore_requested_time = :now',
+        ExpressionAttributeValues={':now': {'N': str(now)}}
+      )
+    except ClientError as e:
+      app.logger.warning('Unable to clear restore request of {}: {}'.format(id, e))
+    return False
+  return True
+
+"""Turn a job's stored result_summary into display values
+Counts come back from DynamoDB as Decimals; annotation counts are shown
+as the share of variants each annotation was found for.
+"""
+def format_result_summary(attribute):
+  summary = TypeDeserializer().deserialize(attribute)
+  variants = int(summary['variants'])
+  counts = lambda name: [(key, int(count)) for key, count in
+    sorted(summary.get(name, {}).items(), key=lambda entry: -entry[1])]
+  return {
+    'variants': variants,
+    'chromosomes': counts('chromosomes'),
+    'types': counts('types'),
+    'filters': counts('filters'),
+    'annotations': [(key, count, 100.0 * count / variants if variants else 0)
+      for key, count in counts('annotations')]
+  }
+
 """Display details of a specific annotation job
 """
 @app.route('/annotations/<id>', methods=['GET'])
 @authenticated
 def annotation_details(id):
     user = session['primary_identity']
-    db = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
-    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    db = aws_client('dynamodb')
+    s3 = aws_client('s3')
     free_access_expired = False
+
+    # Sizes of the job's files in the results bucket; the prefix is
+    # scoped to the session's user, so no authorization is needed first
+    def get_result_sizes():
+        try:
+            listing = s3.list_objects_v2(
+                Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+                Prefix='{}{}/{}~'.format(app.config['AWS_S3_KEY_PREFIX'], user, id))
+        except ClientError as e:
+            app.logger.warning('Unable to list results for {}: {}'.format(id, e))
+            return {}
+        return {obj['Key']: obj['Size'] for obj in listing.get('Contents', [])}
+
     try:
-        # Getting information about specific annotation from Dynamo table
-        response = db.query(
-            TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
-            KeyConditionExpression='job_id = :j',
-            FilterExpression='user_id = :u',
-            ExpressionAttributeValues={
-                ':j': {'S': id},
-                ':u': {'S': user}
-            },
-            ProjectionExpression='job_id, storage_status, job_status, submit_time, input_file_name, complete_time, s3_key_result_file, s3_key_log_fi$
+        # Getting information about specific annotation from Dynamo table,
+        # concurrently with the (independent) results listing
+        response, result_sizes = run_concurrently(
+            lambda: db.query(
+                TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+                KeyConditionExpression='job_id = :j',
+                FilterExpression='user_id = :u',
+                ExpressionAttributeValues={
+                    ':j': {'S': id},
+                    ':u': {'S': user}
+                },
+                ProjectionExpression='job_id, storage_status, job_status, submit_time, input_file_name, complete_time, s3_key_result_file, s3_key_log_file, result_summary, retention_due'
+            ),
+            get_result_sizes
         )
         # Wrong user
         if not response['Items']:
@@ -257,18 +417,32 @@ def annotation_details(id):
         complete_time = float(item['complete_time']['N'])
         annotation['complete_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(complete_time))
         annotation['s3_key_log_file'] = item['s3_key_log_file']['S']
-        complete_sec = time.mktime(time.strptime(annotation['submit_time'], '%Y-%m-%d %H:%M:%S'))
-        # Five minute limit for free users to download the results file
-        if session['role'] == 'free_user' and time.time() - complete_sec > 300:
+        annotation['log_file_size'] = result_sizes.get(annotation['s3_key_log_file'])
+        # Computed by run.py, so no S3 reads are needed to show it
+        if 'result_summary' in item:
+            annotation['summary'] = format_result_summary(item['result_summary'])
+        # Free users can only download the results file during the retention
+        # period, which run.py stamps on the job as retention_due; jobs from
+        # before that, or completed while the user was premium, count it
+        # from the complete time
+        if 'retention_due' in item:
+            retention_due = float(item['retention_due']['N'])
+        else:
+            retention_due = complete_time + app.config['FREE_USER_DATA_RETENTION']
+        if session['role'] == 'free_user' and time.time() > retention_due:
             free_access_expired = True
         # File was archived and is being restored from Glacier Vault
         if 's3_key_result_file' not in response['Items'][0].keys() and annotation['job_status'] == 'COMPLETED':
             annotation['restore_message'] = 'This file is currently being restored. Please try again in a few hours.'
-	else:
+            # The result being looked at is restored ahead of the rest
+            if session['role'] == 'premium_user' and request_job_restore(user, id):
+                annotation['restore_message'] = 'This file is being restored ahead of your other results. Please try again in a few minutes.'
+        else:
             annotation['s3_key_result_file'] = result_file
+            annotation['result_file_size'] = result_sizes.get(result_file)
             try:
                 # Generate download URL for results file
-		# Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/generate_presigned_url.html
+                # Source: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/generate_presigned_url.html
                 result_url = s3.generate_presigned_url(
                     ClientMethod='get_object',
                     Params={
@@ -293,7 +467,7 @@ def annotation_details(id):
 @app.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
 def annotation_log(id):
-    db = boto3.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    db = aws_client('dynamodb')
     user = session['primary_identity']
     try:
         # Getting information about specific annotation from Dynamo table
@@ -308,7 +482,7 @@ def annotation_log(id):
             ProjectionExpression='input_file_name'
         )
 
-	if not response['Items']:
+        if not response['Items']:
                   return jsonify({
                       'code': 500,
                       'status': 'error',
@@ -324,11 +498,13 @@ def annotation_log(id):
   
     input_file = response['Items'][0]['input_file_name']['S']
     log_file = '{}{}/{}~{}.count.log'.format(app.config['AWS_S3_KEY_PREFIX'], user, id, input_file)
-    s3 = boto3.resource('s3', region_name=app.config['AWS_REGION_NAME'])
+    s3 = aws_client('s3')
 
     try:
         # Getting the contents of the log file
-        log_file_contents = s3.Object(app.config['AWS_S3_RESULTS_BUCKET'], log_file).get()['Body'].read().decode('utf-8')
+        log_file_contents = s3.get_object(
+            Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+            Key=log_file)['Body'].read().decode('utf-8')
 
     except Exception as e:
         return jsonify({
@@ -353,7 +529,7 @@ def subscribe():
 
     elif (request.method == 'POST'):
         # Update user role to allow access to paid features
-        update_profile(
+        update_profile_role(
             identity_id=session['primary_identity'],
             role="premium_user"
         )
@@ -366,8 +542,7 @@ def subscribe():
         message = {
             "user_id": session['primary_identity']
         }
-	sqs = boto3.client('sqs', region_name=app.config['AWS_REGION_NAME'])
-        sqs.send_message(
+        aws_client('sqs').send_message(
             QueueUrl=app.config['AWS_SQS_RESTORE_QUEUE'],
             MessageBody=json.dumps(message)
         )
@@ -375,16 +550,68 @@ def subscribe():
         # Display confirmation page
         return render_template('subscribe_confirm.html')
 
+"""Schedule the archiving of a user's results that have no retention_due
+For a user who has just become a free user: results completed while the
+user was premium are due FREE_USER_DATA_RETENTION after they completed,
+as if run.py had stamped them. Returns the number of jobs scheduled.
+"""
+def schedule_retention(user):
+  db = aws_client('dynamodb')
+  scheduled = 0
+  kwargs = {
+    'TableName': app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    'IndexName': 'user_id_index',
+    'KeyConditionExpression': 'user_id = :u',
+    'FilterExpression': 'job_status = :completed',
+    'ExpressionAttributeValues': {
+      ':u': {'S': user},
+      ':completed': {'S': 'COMPLETED'}
+    },
+    'ProjectionExpression': 'job_id'
+  }
+  while True:
+    response = db.query(**kwargs)
+    for item in response['Items']:
+      id = item['job_id']['S']
+      try:
+        db.update_item(
+          TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+          Key={'job_id': {'S': id}},
+          UpdateExpression='SET retention_due = complete_time + :period, retention_shard = :shard',
+          ConditionExpression='attribute_exists(s3_key_result_file) AND attribute_not_exists(retention_due)',
+          ExpressionAttributeValues={
+            ':period': {'N': str(app.config['FREE_USER_DATA_RETENTION'])},
+            # Same shard run.py would have chosen
+            ':shard': {'S': str(zlib.crc32(id.encode('utf-8')) % app.config['GAS_RETENTION_SHARDS'])}
+          }
+        )
+        scheduled += 1
+      except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+          raise
+    if 'LastEvaluatedKey' not in response:
+      return scheduled
+    kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
 """Reset subscription
 """
 @app.route('/unsubscribe', methods=['GET'])
 @authenticated
 def unsubscribe():
     # Hacky way to reset the user's role to a free user; simplifies testing
-    update_profile(
+    update_profile_role(
         identity_id=session['primary_identity'],
         role="free_user"
     )
+    session['role'] = "free_user"
+
+    # Results kept while the user was premium are archived like any
+    # other free user's
+    try:
+        schedule_retention(session['primary_identity'])
+    except ClientError as e:
+        app.logger.error('Unable to schedule retention for {}: {}'.format(
+            session['primary_identity'], e))
     return redirect(url_for('profile'))
 
 